@@ -0,0 +1,207 @@
+
+# lookup of DTT rental agencies from the avis report's pickup location columns.
+#
+# The avis report gives the pickup location as a description ('Rental Loc Desc') and an address
+# ('Address Line 1' is the street, 'Address Line 3' is "CITY ST ZIP").  The DTT agencies have
+# Address/City/State/Zip.  The two are typed by different people, so the strings rarely agree
+# exactly ("6520 McNair Circle" vs "6520 MCNAIR CIR").  Addresses are reduced to a key of street
+# number, normalized street name and 5 digit zip before they are compared.
+#
+# Once an avis location has been resolved by its address, the location description is remembered
+# along with the (raw) address lines it was resolved from, so the next row from the same location
+# is a dict lookup and a string compare: its address isn't normalized again.  If avis moves a
+# location (or reuses a description) the address differs, and the row is resolved again.
+#
+# The remembered locations are saved between runs, separately for each DR, with a digest of the
+# DR's agency list: when the agencies change the saved locations are thrown away.
+
+import re
+import json
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+
+# the avis column used as the location code
+LOCATION_COLUMN = 'Rental Loc Desc'
+
+# common street words -> the usps abbreviation
+STREET_WORDS = {
+        'AVENUE': 'AVE',
+        'BOULEVARD': 'BLVD',
+        'CIRCLE': 'CIR',
+        'COURT': 'CT',
+        'DRIVE': 'DR',
+        'EXPRESSWAY': 'EXPY',
+        'FREEWAY': 'FWY',
+        'HIGHWAY': 'HWY',
+        'LANE': 'LN',
+        'PARKWAY': 'PKWY',
+        'PLACE': 'PL',
+        'ROAD': 'RD',
+        'SQUARE': 'SQ',
+        'STREET': 'ST',
+        'TERRACE': 'TER',
+        'TRAIL': 'TRL',
+        'NORTH': 'N',
+        'SOUTH': 'S',
+        'EAST': 'E',
+        'WEST': 'W',
+        'NORTHEAST': 'NE',
+        'NORTHWEST': 'NW',
+        'SOUTHEAST': 'SE',
+        'SOUTHWEST': 'SW',
+        }
+
+# anything after one of these is a unit within the building; not part of the street
+UNIT_WORDS = frozenset([ 'APT', 'BLDG', 'STE', 'SUITE', 'UNIT' ])
+
+word_re = re.compile(r"[A-Z0-9]+")
+zip_re = re.compile(r"\b(\d{5})(?:-\d{4})?\b")
+
+
+def normalize_street(street):
+    """ return (street number, street name) for an address line; the number is '' if there isn't one """
+
+    words = word_re.findall(street.upper().replace("'", '')) if isinstance(street, str) else []
+
+    number = ''
+    if words and words[0][0].isdigit():
+        number = words.pop(0)
+
+    name = []
+    for word in words:
+        if word in UNIT_WORDS:
+            break
+        name.append(STREET_WORDS.get(word, word))
+
+    return (number, ' '.join(name))
+
+
+def normalize_zip(value):
+    """ the (last) 5 digit zip code in value, or '' """
+
+    if value is None:
+        return ''
+
+    matches = zip_re.findall(str(value))
+    return matches[-1] if matches else ''
+
+
+def normalize_location(value):
+    return ' '.join(value.upper().split()) if isinstance(value, str) else ''
+
+
+def agency_keys(street, zipcode):
+    """ the full (number, street name, zip) key and the (number, zip) fallback key for an address """
+
+    number, name = normalize_street(street)
+    zipcode = normalize_zip(zipcode)
+    return ((number, name, zipcode), (number, zipcode) if number and zipcode else None)
+
+
+class AgencyIndex:
+    """ resolves avis rows to DTT AgencyIDs.
+
+        Lookups return a frozenset of AgencyIDs: the DTT sometimes has the same location listed twice.
+    """
+
+    def __init__(self, agencies, locations=None):
+        self._by_address = {}       # (number, street name, zip) -> set of AgencyIDs
+        self._by_number_zip = {}    # (number, zip) -> set of AgencyIDs
+
+        for agency_id, agency in agencies.items():
+            key, fallback = agency_keys(agency.get('Address'), agency.get('Zip'))
+            self._by_address.setdefault(key, set()).add(agency_id)
+            if fallback is not None:
+                self._by_number_zip.setdefault(fallback, set()).add(agency_id)
+
+        self._by_address = dict( (k, frozenset(v)) for k, v in self._by_address.items() )
+        self._by_number_zip = dict( (k, frozenset(v)) for k, v in self._by_number_zip.items() )
+
+        # avis location -> (address lines, AgencyIDs), learned from earlier rows.  locations must
+        # have been learned against this same agency list (see load_locations)
+        self._by_location = dict( (location, (address, frozenset(ids)))
+                for location, (address, ids) in (locations or {}).items() )
+
+        self._learned = {}          # locations added since the index was built
+
+    def resolve(self, row):
+        """ the AgencyIDs for an avis row's pickup location (empty if it isn't a DTT agency) """
+
+        location = normalize_location(row.get(LOCATION_COLUMN))
+        address = (row.get('Address Line 1'), row.get('Address Line 3'))
+
+        known = self._by_location.get(location)
+        if known is not None:
+            if known[0] == address:
+                return known[1]
+            log.debug(f"avis location '{ location }' has moved from { known[0] } to { address }; resolving it again")
+
+        key, fallback = agency_keys(*address)
+        ids = self._by_address.get(key)
+        if ids is None and fallback is not None:
+            # the street name is spelled differently; a number + zip match is good enough
+            ids = self._by_number_zip.get(fallback)
+
+        if ids is None:
+            return frozenset()
+
+        if location:
+            self._by_location[location] = (address, ids)
+            self._learned[location] = (address, ids)
+
+        return ids
+
+    def learned(self):
+        """ the location -> (address lines, AgencyIDs) entries added since the index was built (see save_locations) """
+        return self._learned
+
+
+def _read_locations(file_name):
+    try:
+        with open(file_name, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_locations(file_name, dr_id, agencies_digest):
+    """ read a DR's saved avis location -> (address lines, AgencyIDs) table.
+
+        The table is only used if it was learned against the same agency list (agencies_digest)
+    """
+
+    saved = _read_locations(file_name).get(dr_id)
+    if not isinstance(saved, dict) or saved.get('agencies') != agencies_digest:
+        return {}
+
+    return dict( (location, (tuple(entry['address']), entry['ids']))
+            for location, entry in saved.get('locations', {}).items() )
+
+
+def save_locations(file_name, dr_id, agencies_digest, locations):
+    """ merge a DR's newly learned locations into the saved table.
+
+        Each DR has its own section: the same avis location resolves to different AgencyIDs in
+        different DRs.  A section learned against a different agency list is replaced.  The file
+        is updated under a lock, since DRs run in parallel with --jobs.
+    """
+
+    with file_store.locked(file_name):
+        saved = _read_locations(file_name)
+
+        # drop the entries of the old flat location -> AgencyIDs table
+        saved = dict( (k, v) for k, v in saved.items() if isinstance(v, dict) )
+
+        section = saved.get(dr_id)
+        if not isinstance(section, dict) or section.get('agencies') != agencies_digest:
+            section = { 'agencies': agencies_digest, 'locations': {} }
+            saved[dr_id] = section
+
+        for location, (address, ids) in locations.items():
+            section['locations'][location] = { 'address': list(address), 'ids': sorted(ids) }
+
+        file_store.write_json(file_name, saved)
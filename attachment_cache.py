@@ -0,0 +1,76 @@
+
+# local cache of mail attachments, keyed by graph message id and attachment id.
+#
+# The Avis report arrives once a day and the staff rosters not much more often, but every run (and
+# every DR) used to search the mailbox and download them again.  With this cache a run only asks
+# for the id of the newest matching message; if we already have that message's attachment the
+# bytes come from disk.
+#
+# Files in the cache directory:
+#   <hash of message id + attachment pattern>.json   which attachment of the message matched
+#   <hash of message id + attachment id>.bin         the attachment contents
+
+import os
+import os.path
+import json
+import hashlib
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+
+def _key(*parts):
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def _match_path(cache_dir, message_id, pattern):
+    return os.path.join(cache_dir, _key(message_id, pattern) + ".json")
+
+
+def _data_path(cache_dir, message_id, attachment_id):
+    return os.path.join(cache_dir, _key(message_id, attachment_id) + ".bin")
+
+
+def lookup(cache_dir, message_id, pattern):
+    """ return the cached contents of the attachment of message_id that matched pattern, or None """
+
+    try:
+        with open(_match_path(cache_dir, message_id, pattern), "r") as f:
+            match = json.load(f)
+
+        with open(_data_path(cache_dir, message_id, match['id']), "rb") as f:
+            contents = f.read()
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # keep entries that are still in use from being pruned.  Another process may have just
+    # pruned them anyway; that only costs a download next time
+    try:
+        os.utime(_data_path(cache_dir, message_id, match['id']))
+        os.utime(_match_path(cache_dir, message_id, pattern))
+    except OSError:
+        pass
+
+    log.debug(f"using cached attachment { match['name'] } ({ len(contents) } bytes)")
+    return contents
+
+
+def store(cache_dir, message_id, pattern, attachment, write_func):
+    """ add an attachment to the cache.  write_func(fd) writes its contents to a binary file.
+
+        Returns the contents.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    data_path = _data_path(cache_dir, message_id, attachment['id'])
+    with file_store.atomic_open(data_path) as fd:
+        write_func(fd)
+
+    file_store.write_json(_match_path(cache_dir, message_id, pattern),
+            { 'id': attachment['id'], 'name': attachment['name'], 'size': attachment.get('size') })
+
+    with open(data_path, "rb") as f:
+        return f.read()
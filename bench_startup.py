@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# measure cold start time of main.py and of each subsystem it loads on demand.
+#
+# Every measurement runs in a fresh interpreter, so nothing is already imported.  The numbers are
+# what an Azure Functions style invocation pays before doing any real work.
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+
+# name, setup code (not timed), code to time
+STAGES = [
+        ('import main',         '', 'import main'),
+        ('spreadsheet modules', 'import main', 'import openpyxl, workbook_styles'),
+        ('DTT web session',     'import main', 'import web_session'),
+        ('O365 / mailbox',      'import main', 'import message'),
+        ('mail templates',      'import main', 'from neil_tools import gen_templates'),
+        ]
+
+TIMER = """
+import time
+{setup}
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def time_stage(setup, code):
+    """ run one stage in a new interpreter; return elapsed seconds, or None if it failed """
+
+    script = TIMER.format(setup=setup, code=code)
+    result = subprocess.run([ sys.executable, '-c', script ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True)
+
+    if result.returncode != 0:
+        last_line = result.stderr.strip().split('\n')[-1]
+        print(f"    failed: { last_line }", file=sys.stderr)
+        return None
+
+    return float(result.stdout.strip().split('\n')[-1])
+
+
+def main():
+    args = parse_args()
+
+    print(f"{ 'stage':<22} { 'min ms':>8} { 'median ms':>10}")
+    for name, setup, code in STAGES:
+        times = []
+        for i in range(args.repeat):
+            t = time_stage(setup, code)
+            if t is None:
+                break
+            times.append(t * 1000)
+
+        if len(times) == 0:
+            print(f"{ name:<22} { 'n/a':>8} { 'n/a':>10}")
+        else:
+            print(f"{ name:<22} { min(times):8.1f} { statistics.median(times):10.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="measure startup time of main.py and its subsystems")
+    parser.add_argument("--repeat", help="number of runs per stage (default: 5)", default=5, type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,34 @@
 
 #COOKIE_FILE = 'dtt.cookies' # name of file to store web session cookies in
-REQUESTS_TIMEOUT = 30       # seconds
+REQUESTS_TIMEOUT = 30       # seconds (read timeout)
+REQUESTS_CONNECT_TIMEOUT = 10   # seconds
+
+# connection pool and retry policy for the DTT http transport
+REQUESTS_POOL_CONNECTIONS = 4   # number of hosts to keep pools for
+REQUESTS_POOL_MAXSIZE = 10      # keep-alive connections per host
+REQUESTS_RETRIES = 4            # retries on connection errors, 429 and 5xx
+REQUESTS_BACKOFF_FACTOR = 1     # seconds; doubles after each retry
+
+# directory for the conditional-GET cache of DTT json responses
+HTTP_CACHE_DIR = 'http_cache'
+
+# directory for the snapshots of run inputs (--save-input, --cached-input, --replay)
+SNAPSHOT_DIR = 'snapshots'
+
+# map from DR code to the DTT's internal DR id, filled in by scraping the Vehicles page
+DR_ID_MAP_FILE = 'dtt_dr_ids.json'
+
+# fingerprints of the inputs of the last successful run of each report (see --force)
+FINGERPRINT_FILE = 'report_fingerprints.json'
+
+# local cache of the avis and roster mail attachments, keyed by message id
+ATTACHMENT_CACHE_DIR = 'attachment_cache'
+
+# pickled parse results of the avis report and staff rosters, keyed by attachment contents
+TABLE_CACHE_DIR = 'table_cache'
+
+# avis pickup locations -> DTT AgencyIDs, learned from earlier avis reports
+AGENCY_LOCATIONS_FILE = 'agency_locations.json'
 
 # siteid for the NHQDCSDLC site
 #SITE_ID = 'americanredcross.sharepoint.com,38988760-70fd-4850-90e4-61f59a1e3bbf,4e1787c4-bf1b-4828-876a-6d7b1613ddec'
@@ -115,7 +143,8 @@ class DRConfig:
 
     @property
     def cookie_filename(self):
-        return f"dtt_cookies-{ self.dr_id }.txt"
+        # cookies belong to the DTT login, so DRs that share a DTT user share the file
+        return f"dtt_cookies-{ self.dtt_user.lower() }.txt"
 
     @property
     def extra_drs(self):
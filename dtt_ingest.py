@@ -0,0 +1,118 @@
+
+# streaming ingest of the large DTT json arrays.
+#
+# The Vehicles and People/Details endpoints return one big json array.  Parsing it with json.loads
+# holds the whole text plus the full dict tree for every record (including Attachments, Drivers,
+# RentalAgreements, the New*Files lists...).  Here we decode the array one element at a time and
+# turn each element into a compact record (see records.py) with just the fields the reports use.
+
+import json
+import codecs
+import hashlib
+import logging
+
+import records
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# characters that can continue a json number
+NUMBER_CHARS = frozenset('0123456789+-.eE')
+
+
+def _fields_id(*field_lists):
+    """ short id of a projection, so cached parses are redone when the record layout changes """
+    h = hashlib.sha256(repr(field_lists).encode())
+    return h.hexdigest()[:12]
+
+VEHICLES_PARSER_ID = f"vehicles-records-{ _fields_id(records.Vehicle.__slots__, records.VehicleDetails.__slots__) }"
+PEOPLE_PARSER_ID = f"people-records-{ _fields_id(records.Person.__slots__) }"
+
+
+def project_vehicle(record):
+    return records.Vehicle(record)
+
+
+def project_person(record):
+    return records.Person(record)
+
+
+def _number_may_continue(buf, end):
+    """ True if the number that ended at buf[end] might go on past the end of buf ('-2' + '.5') """
+    while end < len(buf) and buf[end] in NUMBER_CHARS:
+        end += 1
+    return end == len(buf)
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """ generate the elements of a top level json array read from binary file f, one at a time """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        """ read more of the file into buf, dropping the part we've already consumed """
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+
+    def skip(chars):
+        """ advance pos past any of chars; returns False at end of input """
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf):
+                return True
+            if eof:
+                return False
+            fill()
+
+    whitespace = ' \t\r\n'
+    if not skip(whitespace) or buf[pos] != '[':
+        raise ValueError("expected a json array")
+    pos += 1
+
+    while True:
+        if not skip(whitespace + ','):
+            raise ValueError("unterminated json array")
+
+        if buf[pos] == ']':
+            return
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+
+                # a number at the end of the buffer may have been cut in half, either right after
+                # a digit or after a '.', 'e' or sign the decoder stopped in front of
+                if eof or type(value) not in (int, float) or not _number_may_continue(buf, end):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+            fill()
+
+        pos = end
+        yield value
+
+
+def load_vehicles(f):
+    """ parse a Vehicles payload from binary file f into records.Vehicle objects """
+    return [ project_vehicle(record) for record in iter_json_array(f) ]
+
+
+def load_people(f):
+    """ parse a People/Details payload from binary file f into records.Person objects """
+    return [ project_person(record) for record in iter_json_array(f) ]
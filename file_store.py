@@ -0,0 +1,92 @@
+
+# helpers for the files the caches and stores keep on disk.
+#
+# Several processes (--jobs) and threads may read a cache file while another one rewrites it, so
+# files are always written to a temporary name and renamed over the old one: a reader sees either
+# the old contents or the new, never a partial file.  A file that is read, updated and written back
+# is changed under locked(), so two writers don't lose each other's updates.  The cache directories
+# are pruned of entries that haven't been used (their mtime touched) recently.
+
+import os
+import os.path
+import json
+import time
+import threading
+import contextlib
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    # not on windows; locked() doesn't lock there
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def atomic_open(file_name, mode="wb", private=False):
+    """ open a temporary file that replaces file_name when the with block finishes without an error.
+
+        A private file is only readable by its owner.
+    """
+
+    # unique per process and thread, so two writers never share a temporary file
+    tmp_name = f"{ file_name }.tmp{ os.getpid() }-{ threading.get_ident() }"
+    try:
+        if private:
+            f = os.fdopen(os.open(tmp_name, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), mode)
+        else:
+            f = open(tmp_name, mode)
+
+        with f:
+            yield f
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def write_atomic(file_name, contents, private=False):
+    """ write bytes (or a string) to file_name so readers never see a partial copy """
+
+    with atomic_open(file_name, "wb", private=private) as f:
+        f.write(contents.encode() if isinstance(contents, str) else contents)
+
+
+def write_json(file_name, data):
+    """ write data as (sorted, indented) json, atomically """
+    write_atomic(file_name, json.dumps(data, indent=2, sort_keys=True))
+
+
+@contextlib.contextmanager
+def locked(file_name):
+    """ hold an exclusive lock (on file_name.lock) for the with block; for read-modify-write updates """
+
+    with open(file_name + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def prune(cache_dir, max_age_days):
+    """ remove the files in cache_dir that haven't been used in max_age_days """
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    cutoff = time.time() - max_age_days * 86400
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,62 @@
+
+# change detection for the generated reports.
+#
+# A report's fingerprint is a hash of everything that goes into it (DTT data, roster, Avis
+# attachment, recipients and delivery options).  The fingerprint of the last successful run of
+# each report is kept on disk; if a new run computes the same fingerprint the report would be
+# identical, so generating, uploading and mailing it again can be skipped.
+
+import json
+import hashlib
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+
+def digest_bytes(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+def _json_default(value):
+    """ records (see records.py) are hashed by their fields; anything else by its string form """
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    return str(value)
+
+
+def digest_json(data):
+    """ hash of a json-like structure, independent of dict ordering """
+    normalized = json.dumps(data, sort_keys=True, separators=(',', ':'), default=_json_default)
+    return digest_bytes(normalized.encode())
+
+
+def combine(*parts):
+    """ combine digests (or any other values) into one fingerprint """
+    return digest_json([ str(p) for p in parts ])
+
+
+def load_fingerprints(file_name):
+    try:
+        with open(file_name, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_unchanged(file_name, key, fp):
+    """ True if fp matches the fingerprint recorded for the last successful run of key """
+    return load_fingerprints(file_name).get(key) == fp
+
+
+def record(file_name, key, fp):
+    """ remember fp as the fingerprint of the last successful run of key """
+
+    # parallel --jobs workers each record their own DR's keys in the same file
+    with file_store.locked(file_name):
+        fingerprints = load_fingerprints(file_name)
+        fingerprints[key] = fp
+
+        file_store.write_json(file_name, fingerprints)
@@ -0,0 +1,93 @@
+
+# approximate string lookup for vehicle identifiers.
+#
+# When an Avis agreement, reservation, key or plate isn't in the DTT it is usually a typo on one
+# side or the other.  A DeletionIndex finds every DTT value within a small edit distance of the
+# Avis value without comparing it against every vehicle.
+#
+# Any two strings within edit distance d share a string reachable from both by deleting at most d
+# characters, so each value is indexed under all of its deletion variants.  A query looks up the
+# variants of the query string and checks only the values it finds.  The identifiers are short
+# (under ~15 characters), so a value has at most a hundred or so variants.
+
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def levenshtein(a, b, max_distance=None):
+    """ edit distance between a and b.  With max_distance, anything over the limit is returned as max_distance + 1 """
+
+    if a == b:
+        return 0
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [ i ]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                    previous[j] + 1,                # deletion
+                    current[j - 1] + 1,             # insertion
+                    previous[j - 1] + (ca != cb),   # substitution
+                    ))
+
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
+
+
+def deletion_variants(value, max_deletions):
+    """ the set of strings made by deleting up to max_deletions characters from value (including value) """
+
+    variants = { value }
+    for n in range(1, min(max_deletions, len(value)) + 1):
+        for positions in itertools.combinations(range(len(value)), n):
+            variants.add(''.join(c for i, c in enumerate(value) if i not in positions))
+    return variants
+
+
+class DeletionIndex:
+    """ index of strings for lookups within a bounded levenshtein distance """
+
+    def __init__(self, values=(), max_distance=2):
+        self._max_distance = max_distance
+        self._variants = {}     # deletion variant -> [ values ]
+
+        for value in values:
+            self.add(value)
+
+    @property
+    def max_distance(self):
+        return self._max_distance
+
+    def add(self, value):
+        for variant in deletion_variants(value, self._max_distance):
+            self._variants.setdefault(variant, []).append(value)
+
+    def search(self, value, max_distance=None):
+        """ return [ (distance, value) ] for every indexed value within max_distance, closest first """
+
+        if max_distance is None or max_distance > self._max_distance:
+            max_distance = self._max_distance
+
+        candidates = set()
+        for variant in deletion_variants(value, max_distance):
+            candidates.update(self._variants.get(variant, ()))
+
+        results = []
+        for candidate in candidates:
+            d = levenshtein(value, candidate, max_distance)
+            if d <= max_distance:
+                results.append((d, candidate))
+
+        results.sort()
+        return results
@@ -0,0 +1,129 @@
+
+# on-disk conditional-GET cache for the DTT json endpoints.
+#
+# Each entry is stored by DR and endpoint and holds the url it was fetched from, the validators
+# the server sent (ETag and Last-Modified), a sha256 of the raw body, the raw body itself, and a
+# pickle of the parsed json.  An entry for a different url (the DR's DTT id changed) is a miss.
+# On the next run we send If-None-Match/If-Modified-Since; a 304 (or a 200 whose body hashes
+# the same as last time) means we can load the pickle and skip the json parse entirely.
+#
+# The response body is streamed straight to disk and parsed from the file, so the raw text is
+# never held in memory as a whole.
+
+import os
+import os.path
+import re
+import json
+import pickle
+import hashlib
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _entry_base(cache_dir, dr_id, api_type):
+    """ return the path prefix for all the files of a cache entry """
+    api_name = re.sub(r'[^A-Za-z0-9]+', '_', api_type)
+    return os.path.join(cache_dir, f"{ dr_id }_{ api_name }")
+
+
+def _load_entry(base):
+    """ return the metadata for an entry, or None if there isn't a usable one """
+
+    try:
+        with open(base + ".meta.json", "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.exists(base + ".pickle"):
+        return None
+
+    return meta
+
+
+def _load_data(base):
+    with open(base + ".pickle", "rb") as f:
+        return pickle.load(f)
+
+
+def get_body(cache_dir, dr_id, api_type):
+    """ return the raw bytes of the most recent response for this endpoint """
+    with open(_entry_base(cache_dir, dr_id, api_type) + ".body", "rb") as f:
+        return f.read()
+
+
+def fetch_json(session, url, cache_dir, dr_id, api_type, timeout=None, parse=json.load, parser_id='json'):
+    """ GET url, using (and refreshing) the cache entry for dr_id/api_type.  Returns the parsed json
+
+        parse is called with the body as a binary file.  parser_id names the parse function; a
+        cached parse made by a different parser is not reused.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    base = _entry_base(cache_dir, dr_id, api_type)
+    meta = _load_entry(base)
+
+    if meta is not None and meta.get('url') != url:
+        # the DR's DTT id (or the DTT address) changed: the entry is for some other data
+        log.debug(f"{ api_type }: cached copy is for { meta.get('url') }; ignoring it")
+        meta = None
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    parse_current = meta is not None and meta.get('parser') == parser_id
+
+    r = session.get(url, headers=headers, timeout=timeout, stream=True)
+
+    if r.status_code == 304 and meta is not None:
+        r.close()
+        if parse_current:
+            log.debug(f"{ api_type }: not modified; using cached copy")
+            return _load_data(base)
+
+        # the body is the same but it was parsed differently last time
+        with open(base + ".body", "rb") as f:
+            data = parse(f)
+        file_store.write_atomic(base + ".pickle", pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        meta['parser'] = parser_id
+        file_store.write_atomic(base + ".meta.json", json.dumps(meta, indent=2).encode())
+        return data
+
+    r.raise_for_status()
+
+    # stream the body to disk, hashing as we go
+    h = hashlib.sha256()
+    with file_store.atomic_open(base + ".body") as f:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    if parse_current and meta.get('sha256') == digest:
+        # server doesn't do validators (or ignored them), but nothing changed
+        log.debug(f"{ api_type }: content unchanged; using cached copy")
+        data = _load_data(base)
+    else:
+        with open(base + ".body", "rb") as f:
+            data = parse(f)
+        file_store.write_atomic(base + ".pickle", pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+    new_meta = {
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'sha256': digest,
+            'parser': parser_id,
+            }
+    file_store.write_atomic(base + ".meta.json", json.dumps(new_meta, indent=2).encode())
+
+    return data
@@ -11,29 +11,28 @@ import io
 import zipfile
 import itertools
 import functools
-
-import openpyxl
-import openpyxl.utils
-import openpyxl.styles
-import openpyxl.styles.colors
-import openpyxl.writer.excel
-from openpyxl.comments import Comment
-
-import requests
+from concurrent import futures
 
 import neil_tools
-from neil_tools import spreadsheet_tools
-from neil_tools import gen_templates
 
 import config as config_static
-import web_session
-import message
-import veh_stats
-
-import arc_o365
-#from O365_local.excel import WorkBook as o365_WorkBook
-import O365
-from O365.excel import WorkBook as o365_WorkBook
+import http_cache
+import dtt_ingest
+import snapshot
+import fingerprint
+import file_store
+import o365_accounts
+import table_cache
+import records
+import reconcile
+import agency_index
+from reconcile import (AVIS_SOURCE, AVIS_SOURCE_OPEN, AVIS_SOURCE_OPEN_ALL, AVIS_SOURCE_CLOSED,
+        AVIS_SOURCE_CLOSED_ALL, AVIS_SOURCE_MISSING)
+
+# The heavy subsystems (openpyxl, requests_html via web_session, O365 via message/arc_o365,
+# the jinja templates) are imported by the functions that use them, so each --do-* mode only
+# pays for what it needs.  The cell styles live in workbook_styles, which imports openpyxl.
+# See bench_startup.py for startup timings.
 
 
 
@@ -43,29 +42,17 @@ TIMESTAMP = NOW.strftime("%Y-%m-%d %H:%M:%S %Z")
 FILESTAMP = NOW.strftime("%Y-%m-%d %H-%M-%S %Z")
 EMAILSTAMP = NOW.strftime("%Y-%m-%d %H-%M")
 
-# flag field in vehicle structures
-IN_AVIS = '__IN_AVIS__'
-
-# flag field in avis object array
-AVIS_SOURCE = '__AVIS_SOURCE__'
-AVIS_SOURCE_OPEN       = 'OPEN'
-AVIS_SOURCE_OPEN_ALL   = 'OPEN_ALL'
-AVIS_SOURCE_CLOSED     = 'CLOSED'
-AVIS_SOURCE_CLOSED_ALL = 'CLOSED_ALL'
-AVIS_SOURCE_MISSING    = 'MISSING'
-
-FILL_RED = openpyxl.styles.PatternFill(fgColor="FFC0C0", fill_type = "solid")
-FILL_GREEN = openpyxl.styles.PatternFill(fgColor="C0FFC0", fill_type = "solid")
-FILL_YELLOW = openpyxl.styles.PatternFill(fgColor="FFFFC0", fill_type = "solid")
-FILL_BLUE = openpyxl.styles.PatternFill(fgColor="5BB1CD", fill_type = "solid")
-FILL_CYAN = openpyxl.styles.PatternFill(fgColor="A0FFFF", fill_type = "solid")
-
-# flag in person object that they have a vehicle
-PERSON_VEHICLES = '__PERSON_VEHICLES__'
-PERSON_REF = '__PERSON_REF__'
-ROSTER_REF = '__ROSTER_REF__'
-DISTRICT = '__DISTRICT__'
-TnM = '__TnM__'
+# the avis workbook is one national file: it is fetched and parsed once per run and shared by
+# every DR.  See fetch_avis() and load_avis_tables().
+AVIS_OPEN_SHEET = 'Open RA'
+AVIS_CLOSED_SHEET = 'Closed RA'
+AVIS_SHEETS = (AVIS_OPEN_SHEET, AVIS_CLOSED_SHEET)
+_avis_fetched = None        # (contents, sent_dt) of the newest avis workbook in the mailbox
+_avis_tables = {}           # content digest -> ({ sheet name: (title_row, avis_columns, avis_all, rows_by_dr) }, AvisRowIndex)
+
+# ids of the parsed-table formats kept in the table cache; change them when the parse output changes
+AVIS_PARSER_ID = 'avis-titled-columns-3'
+ROSTER_PARSER_ID = 'roster-records-1'
 
 COMMENT_AUTHOR = "Avis Report Reconciler Program"
 
@@ -103,6 +90,12 @@ def main():
         retval = do_store_avis(config, account_avis)
         return retval
 
+    if args.replay:
+        # the snapshot knows which DR it came from
+        args.replay = snapshot.resolve(config.SNAPSHOT_DIR, args.replay)
+        args.dr_id = [ snapshot.load(args.replay).dr_id ]
+        log.info(f"replaying snapshot { args.replay } for dr { args.dr_id[0] }")
+
     for dr in args.dr_id:
         if dr not in config.DR_CONFIGURATIONS:
             log.error(f"specified DR ID '{ dr }' not found in configured DRs.  Valid DRs are { list(config.DR_CONFIGURATIONS.keys()) }")
@@ -112,9 +105,70 @@ def main():
         sys.exit(1)
 
 
-    for dr in args.dr_id:
-        roster = None
-        dr_config = config.DR_CONFIGURATIONS[dr]
+    if args.jobs > 1 and len(args.dr_id) > 1:
+        if needs_live_avis(args):
+            # fetch and parse the avis workbook here, so the workers don't each do it
+            account_avis = init_o365(config, config.TOKEN_FILENAME_AVIS)
+            load_avis_tables(config, fetch_avis(config, account_avis))
+
+        errors = run_drs_parallel(args)
+    else:
+        if needs_live_avis(args) or (args.do_avis and args.store):
+            # share one avis login across all the DRs (--store uploads the report with it)
+            account_avis = init_o365(config, config.TOKEN_FILENAME_AVIS)
+
+        for dr in args.dr_id:
+            if not process_dr(config, args, dr, account_avis):
+                errors = True
+
+    if errors:
+        sys.exit(1)
+
+
+def needs_live_avis(args):
+    """ True if the avis workbook comes from the mailbox; --replay and --cached-input read it from a snapshot """
+    return args.do_avis and not args.replay and not args.cached_input
+
+
+def process_dr(config, args, dr, account_avis=None):
+    """ run all the requested reports for a single DR.  Returns True if the DR ran without errors
+
+        All the inputs the run reads are collected in a snapshot: with --save-input it is written
+        to the snapshot store when the run finishes (even if it failed); with --replay or
+        --cached-input the inputs come from a stored snapshot instead of the network.
+    """
+
+    snap = None
+    if args.replay:
+        snap = snapshot.load(args.replay)
+    elif args.cached_input:
+        path = snapshot.find_latest(config.SNAPSHOT_DIR, dr)
+        if path is None:
+            log.error(f"no saved snapshot for dr { dr } in { config.SNAPSHOT_DIR }")
+            return False
+        snap = snapshot.load(path)
+    elif args.save_input:
+        snap = snapshot.Snapshot(dr)
+
+    try:
+        return run_dr_pipeline(config, args, dr, account_avis, snap)
+    except snapshot.MissingInput as e:
+        log.error(f"cannot replay dr { dr }: { e.args[0] }")
+        return False
+    finally:
+        if snap is not None and not snap.is_replay:
+            snap.save(config.SNAPSHOT_DIR, now=NOW)
+
+
+def run_dr_pipeline(config, args, dr, account_avis, snap):
+    """ fetch the inputs and generate the requested reports for a DR """
+
+    roster = None
+    dr_config = config.DR_CONFIGURATIONS[dr]
+
+    session = None
+    if snap is None or not snap.is_replay:
+        import web_session
 
         # fetch from DTT
         session = web_session.get_session(config, dr_config)
@@ -125,94 +179,213 @@ def main():
             success = get_dr_list(config, dr_config, session)
             if not success:
                 log.error(f"Could not access DTT for dr { dr }")
-                errors = True
-                continue
+                return False
 
-        #log.debug(f"DR_ID { dr }")
+    #log.debug(f"DR_ID { dr }")
 
-        # get people and vehicles from the DTT
-        vehicles = get_vehicles(config, dr_config, args, session)
-        people = get_people(config, dr_config, args, session)
-        agencies = get_agencies(config, dr_config, args, session)
+    # get people and vehicles from the DTT
+    vehicles, people, agencies, fetch_errors = fetch_dtt_data(config, dr_config, args, session, snap=snap)
 
-        account_mail = None
+    if session is not None and (fetch_errors or not vehicles):
+        # the DTT id in the map may be stale (the DR was renumbered): look it up again
+        log.info(f"dr { dr }: nothing fetched for DTT id { dr_config.id }; checking the DR list")
+        if refresh_dr_id(config, dr_config, session):
+            vehicles, people, agencies, fetch_errors = fetch_dtt_data(config, dr_config, args, session, snap=snap)
 
-        if args.send or args.test_send or args.send_to:
-            #log.debug(f"initializing mail account: { dr_config.token_filename }")
-            account_mail = init_o365(config, dr_config.token_filename, scopes=SCOPES_DRO_EMAIL)
+    if fetch_errors:
+        log.error(f"Could not fetch { list(fetch_errors.keys()) } from DTT for dr { dr }")
+        return False
 
+    # fingerprint the DTT data now: the report stages annotate the records with cross links
+    digests = {}
+    if args.do_avis or args.do_group:
+        digests['vehicles'] = fingerprint.digest_json(vehicles)
+        digests['people'] = fingerprint.digest_json(people)
+        digests['agencies'] = fingerprint.digest_json(agencies)
 
-        if args.do_car or args.do_no_car:
-            if not roster:
-                roster = get_roster(config, dr, dr_config, vehicles, people)
+    account_mail = None
 
-            do_status_messages(dr_config, args, account_mail, vehicles, people, roster)
+    if args.send or args.test_send or args.send_to:
+        #log.debug(f"initializing mail account: { dr_config.token_filename }")
+        account_mail = init_o365(config, dr_config.token_filename, scopes=SCOPES_DRO_EMAIL)
 
 
-        # avis report
-        if args.do_avis:
-            if account_avis == None:
-                account_avis = init_o365(config, config.TOKEN_FILENAME_AVIS)
+    if args.do_car or args.do_no_car:
+        if not roster:
+            roster = get_roster(config, dr, dr_config, vehicles, people, snap=snap)
 
-            # fetch the avis spreadsheet
-            output_bytes = make_avis(config, dr_config, account_avis, vehicles, agencies)
+        do_status_messages(dr_config, args, account_mail, vehicles, people, roster)
 
-            file_name = f"DR{ dr_config.dr_id } { FILESTAMP } Avis Report.xlsx"
-            if args.store:
-                store_report(config, account_avis, file_name, output_bytes)
 
-            # save a local copy
-            #log.debug(f"storing avis report to { file_name }")
-            with open(file_name, "wb") as fb:
-                fb.write(output_bytes)
+    # avis report
+    if args.do_avis:
+        if account_avis == None and (args.store or snap is None or not snap.is_replay):
+            account_avis = init_o365(config, config.TOKEN_FILENAME_AVIS)
 
-            if args.send or args.test_send:
-                send_avis_report(config, dr_config, args, account_mail, file_name)
+        # fetch the avis spreadsheet
+        avis_contents = fetch_avis(config, account_avis, snap=snap)
 
-            if not args.save:
-                os.remove(file_name)
+        report_fp = fingerprint.combine(
+                digests['vehicles'], digests['agencies'], fingerprint.digest_bytes(avis_contents),
+                reconcile.get_translations().digest,
+                delivery_options(args, dr_config.avis_list, args.extra_avis), args.avis_results,
+                args.avis_results_only)
 
-        # group vehicle report
-        if args.do_group:
-            if not roster:
-                roster = get_roster(config, dr, dr_config, vehicles, people)
+        if report_unchanged(config, args, dr, 'avis', report_fp):
+            log.info(f"dr { dr }: avis report inputs are unchanged since the last run; skipping it")
+        else:
+            do_avis_report(config, dr_config, args, account_avis, account_mail, avis_contents, vehicles, agencies)
+            fingerprint.record(config.FINGERPRINT_FILE, f"{ dr }/avis", report_fp)
 
-            # generate the group report
-            output_bytes = make_group_report(config, dr_config, args, vehicles, people, roster)
-            file_name = f"DR{ dr_config.dr_id } { FILESTAMP } Group Vehicle Report.xlsx"
+    # group vehicle report
+    if args.do_group:
+        if not roster:
+            roster = get_roster(config, dr, dr_config, vehicles, people, snap=snap)
 
-            if args.store:
-                store_report(config, account_mail, file_name, output_bytes)
+        report_fp = fingerprint.combine(
+                digests['vehicles'], digests['people'], fingerprint.digest_json(roster),
+                delivery_options(args, dr_config.target_list, args.extra_group))
 
-            # save a local copy for attachment
-            log.debug(f"storing gap report to { file_name }")
-            with open(file_name, "wb") as fb:
-                fb.write(output_bytes)
+        if report_unchanged(config, args, dr, 'group', report_fp):
+            log.info(f"dr { dr }: group vehicle report inputs are unchanged since the last run; skipping it")
+        else:
+            do_group_report(config, dr_config, args, account_mail, vehicles, people, roster)
+            fingerprint.record(config.FINGERPRINT_FILE, f"{ dr }/group", report_fp)
 
-            if args.send or args.test_send:
-                send_group_report(config, dr_config, args, account_mail, file_name)
+    if args.do_vehicles:
+        output_bytes = make_vehicle_backup(config, dr_config, vehicles)
 
-            if not args.save:
-                os.remove(file_name)
+        if args.store:
+            item_name = f"DR{ dr_config.dr_id } { FILESTAMP } Vehicle Backup.xlsx"
+            store_report(config, account_mail, item_name, output_bytes)
 
-        if args.do_vehicles:
-            output_bytes = make_vehicle_backup(config, dr_config, vehicles)
+    if args.do_dtr:
+        dtr = make_dtr(args, account_mail, dr_config, vehicles)
 
-            if args.store:
-                item_name = f"DR{ dr_config.dr_id } { FILESTAMP } Vehicle Backup.xlsx"
-                store_report(config, account_mail, item_name, output_bytes)
+    return True
 
-        if args.do_dtr:
-            dtr = make_dtr(args, account_mail, dr_config, vehicles)
 
-    if errors:
-        sys.exit(1)
+def delivery_options(args, dest_email, extra_recipients):
+    """ the options that change what happens to a report, so they are part of its fingerprint """
+    return [ args.send, args.test_send, args.store, args.save, dest_email, sorted(extra_recipients or []) ]
+
+
+def report_unchanged(config, args, dr, report_type, report_fp):
+    """ True if the report can be skipped: same inputs as the last successful run, and no --force """
+    if args.force:
+        return False
+    return fingerprint.is_unchanged(config.FINGERPRINT_FILE, f"{ dr }/{ report_type }", report_fp)
+
+
+def do_avis_report(config, dr_config, args, account_avis, account_mail, avis_contents, vehicles, agencies):
+    """ generate the avis report, then store and send it as requested """
+
+    results_file = None
+    if args.avis_results:
+        results_file = (f"DR{ dr_config.dr_id } { FILESTAMP } Avis Results.{ args.avis_results }", args.avis_results)
+
+    if args.avis_results_only:
+        # just the matching results: there is no workbook to build, store or send
+        _, _, avis_open, _, results = match_avis(config, dr_config, avis_contents, vehicles, agencies)
+        file_name, file_format = results_file
+        reconcile.write_results(file_name, avis_open, results, file_format=file_format)
+        return
+
+    output_bytes = make_avis(config, dr_config, avis_contents, vehicles, agencies, results_file=results_file)
+
+    file_name = f"DR{ dr_config.dr_id } { FILESTAMP } Avis Report.xlsx"
+    if args.store:
+        store_report(config, account_avis, file_name, output_bytes)
+
+    # save a local copy
+    #log.debug(f"storing avis report to { file_name }")
+    with open(file_name, "wb") as fb:
+        fb.write(output_bytes)
+
+    if args.send or args.test_send:
+        send_avis_report(config, dr_config, args, account_mail, file_name)
+
+    if not args.save:
+        os.remove(file_name)
+
+
+def do_group_report(config, dr_config, args, account_mail, vehicles, people, roster):
+    """ generate the group vehicle report, then store and send it as requested """
+
+    output_bytes = make_group_report(config, dr_config, args, vehicles, people, roster)
+    file_name = f"DR{ dr_config.dr_id } { FILESTAMP } Group Vehicle Report.xlsx"
+
+    if args.store:
+        store_report(config, account_mail, file_name, output_bytes)
+
+    # save a local copy for attachment
+    log.debug(f"storing gap report to { file_name }")
+    with open(file_name, "wb") as fb:
+        fb.write(output_bytes)
+
+    if args.send or args.test_send:
+        send_group_report(config, dr_config, args, account_mail, file_name)
+
+    if not args.save:
+        os.remove(file_name)
+
+
+def init_dr_worker(avis_fetched, avis_tables):
+    """ worker process initializer: seed the avis caches with what the parent already loaded """
+    global _avis_fetched
+
+    _avis_fetched = avis_fetched
+    _avis_tables.update(avis_tables)
+
+
+def run_dr_worker(args, dr):
+    """ entry point for a DR running in a worker process (see run_drs_parallel) """
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    config = neil_tools.init_config(config_static, ".env")
+    return process_dr(config, args, dr)
+
+
+def run_drs_parallel(args):
+    """ run each DR in its own worker process, up to args.jobs at a time.
+
+        Each worker does its own logins, so a slow or stuck DR only holds up its own worker.
+        Returns True if any DR had errors.
+    """
+
+    errors = False
+    results = {}
+
+    with futures.ProcessPoolExecutor(max_workers=args.jobs,
+            initializer=init_dr_worker, initargs=(_avis_fetched, _avis_tables)) as executor:
+        pending = dict( (executor.submit(run_dr_worker, args, dr), dr) for dr in args.dr_id )
+
+        for future in futures.as_completed(pending):
+            dr = pending[future]
+            try:
+                success = future.result()
+            except (Exception, SystemExit) as e:
+                # note: fatal errors deep in the pipeline call sys.exit(); treat them as a DR failure
+                log.error(f"dr { dr } failed: { type(e).__name__ } { e }")
+                success = False
+
+            results[dr] = success
+            if not success:
+                errors = True
+
+    for dr in args.dr_id:
+        log.info(f"dr { dr }: { 'ok' if results.get(dr) else 'FAILED' }")
+
+    return errors
 
 
 #
 # read the avis report from the dr-report-automation mailbox, and save it in sharepoint
 #
 def do_store_avis(config, account):
+    import message
 
     # read the attachment
     contents, sent_dt = message.fetch_avis_open_closed(config, account)
@@ -244,14 +417,22 @@ def do_store_avis(config, account):
     return 0
 
 
-def get_roster(config, dr, dr_config, vehicles, people):
-    roster_contents = message.fetch_dr_roster(config, dr, dr_config)
+def get_roster(config, dr, dr_config, vehicles, people, snap=None):
+    import message
+
+    if snap is not None and snap.is_replay:
+        roster_contents = snap.get(snapshot.ROSTER_MEMBER)
+    else:
+        roster_contents = message.fetch_dr_roster(config, dr, dr_config)
+        if snap is not None and roster_contents is not None:
+            snap.add(snapshot.ROSTER_MEMBER, roster_contents)
 
     if roster_contents == None:
         log.fatal(f"could not fetch roster for { dr }" )
         sys.exit(1)
 
-    roster = message.convert_roster_to_objects(roster_contents)
+    roster = table_cache.load(config.TABLE_CACHE_DIR, 'roster', ROSTER_PARSER_ID, roster_contents,
+            parse_roster)
 
     key_name = 'Mem#'
 
@@ -266,12 +447,81 @@ def get_roster(config, dr, dr_config, vehicles, people):
     return roster_by_vc
 
 
+def parse_roster(roster_contents):
+    """ convert the staff roster spreadsheet to a list of records.RosterEntry """
+    import message
+
+    return [ records.RosterEntry(d) for d in message.convert_roster_to_objects(roster_contents) ]
+
+
 def get_dr_list(config, dr_config, session):
-    """ Get the list of DRs we have access to from the DTT """
+    """ make sure we are logged into the DTT and find its internal id for this DR.
+
+        The DR code -> DTT id map is kept on disk; the (heavy) Vehicles page is only scraped
+        when the DR isn't in the map yet.
+    """
+
+    import web_session
+
+    if not web_session.probe_login(config, session):
+        log.error("DTT login probe failed")
+        return None
+
+    dr_key = make_dr_key(dr_config.dr_num, dr_config.dr_year)
+    dr_map = load_dr_id_map(config)
+
+    if dr_key not in dr_map:
+        log.debug(f"dr { dr_key } not in DTT id map; scraping the DR list")
+        scraped = scrape_dr_list(config, session)
+        if scraped is None:
+            return None
+
+        dr_map = save_dr_id_map(config, scraped)
+
+        if dr_key not in dr_map:
+            log.error(f"dr { dr_config.dr_id } is not one of the DRs this account can see: { list(scraped.keys()) }")
+            return None
+
+    entry = dr_map[dr_key]
+    dr_config.id = entry['id']
+    dr_config.name = entry['name']
+
+    return dr_config.id
+
+
+def refresh_dr_id(config, dr_config, session):
+    """ forget the mapped DTT id for this DR and scrape it again.  True if the id changed """
+
+    old_id = dr_config.id
+    forget_dr_id(config, make_dr_key(dr_config.dr_num, dr_config.dr_year))
+
+    if get_dr_list(config, dr_config, session) is None:
+        return False
+
+    if dr_config.id == old_id:
+        return False
+
+    log.info(f"dr { dr_config.dr_id }: DTT id changed from { old_id } to { dr_config.id }")
+    return True
+
+
+dr_code_re = re.compile(r'^\s*(?:DR)?\s*0*(\d+)-(?:20)?(\d\d)\b', flags=re.IGNORECASE)
+def make_dr_key(dr_num, dr_year):
+    """ canonical form of a DR code (098-2021, 98-21 -> 98-21) used as the DTT id map key """
+    return f"{ dr_num.lstrip('0') }-{ dr_year[-2:] }"
+
+
+def scrape_dr_list(config, session):
+    """ read the list of DRs we have access to from the DTT Vehicles page.
+
+        Returns a dict of DR key to { 'id', 'name' }, or None if the page couldn't be read
+    """
+
+    import web_session
 
     url = config.DTT_URL + "Vehicles"
 
-    r = session.get(url)
+    r = session.get(url, timeout=web_session.get_timeout(config))
     r.raise_for_status()
 
     codes = r.html.find('#DisasterCodes', first=True)
@@ -283,24 +533,60 @@ def get_dr_list(config, dr_config, session):
 
         return None
 
-    options = codes.find('option')
-
-    for option in options:
+    result = {}
+    for option in codes.find('option'):
         value = option.attrs['value']
         text = option.text
         #log.debug(f"option value { value } text { text }")
 
-    # for now, while we only have access to one DR: pick the last value
-    dr_config.id = value
-    dr_config.name = text
+        match = dr_code_re.match(text)
+        if match is None:
+            log.debug(f"could not find a DR code in option '{ text }'")
+            continue
 
-    return value
+        result[make_dr_key(match.group(1), match.group(2))] = { 'id': value, 'name': text }
+
+    return result
+
+
+def load_dr_id_map(config):
+    """ read the on-disk DR key -> DTT id map; returns an empty dict if there isn't one """
+
+    try:
+        with open(config.DR_ID_MAP_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_dr_id_map(config, entries):
+    """ merge new entries into the on-disk DR id map and return the merged map """
+
+    # parallel --jobs workers may update the map at the same time
+    with file_store.locked(config.DR_ID_MAP_FILE):
+        dr_map = load_dr_id_map(config)
+        dr_map.update(entries)
+
+        file_store.write_json(config.DR_ID_MAP_FILE, dr_map)
+
+    return dr_map
+
+
+def forget_dr_id(config, dr_key):
+    """ drop a (stale) entry from the on-disk DR id map, so the next lookup scrapes it again """
+
+    with file_store.locked(config.DR_ID_MAP_FILE):
+        dr_map = load_dr_id_map(config)
+        if dr_map.pop(dr_key, None) is not None:
+            file_store.write_json(config.DR_ID_MAP_FILE, dr_map)
 
 
 
 def make_vehicle_backup(config, dr_config, vehicles):
     """ generate a spreadsheet of all the vehicles as a backup """
 
+    import openpyxl
+
     wb = openpyxl.Workbook()
     ws = wb.create_sheet("Backup")
 
@@ -450,6 +736,7 @@ or have other tasks you think should be automated on a DR: email
 
 
 def send_report_common(dr_config, args, account, file_name, report_type, message_body, dest_email, extra_recipients=[]):
+    import requests
 
     message = account.new_message(resource=dr_config.send_email)
 
@@ -504,26 +791,48 @@ f"""
 
 
 
-def fetch_avis(config, account):
-    """ get the most recent avis workbook """
+def fetch_avis(config, account, snap=None):
+    """ get the contents of the most recent avis workbook.
 
-    contents, sent_dt = message.fetch_avis_open_closed(config, account)
+        The mailbox is only searched once per process; later DRs reuse the same workbook.
+    """
+    global _avis_fetched
+
+    if snap is not None and snap.is_replay:
+        contents = snap.get(snapshot.AVIS_MEMBER)
+        sent_dt = datetime.datetime.fromisoformat(snap.require_meta('avis_sent'))
+    else:
+        if _avis_fetched is None:
+            import message
+
+            contents, sent_dt = message.fetch_avis_open_closed(config, account)
+
+            if contents is None:
+                raise Exception("fetch_avis: no valid files found")
+
+            _avis_fetched = (contents, sent_dt)
+
+        contents, sent_dt = _avis_fetched
+
+        if snap is not None:
+            snap.add(snapshot.AVIS_MEMBER, contents)
+            snap.set_meta('avis_sent', sent_dt.isoformat())
 
-    if contents is None:
-        raise Exception("fetch_avis: no valid files found")
     log.debug(f"sent_dt { sent_dt }")
     config['AVIS_FILE_DATE'] = sent_dt
 
-    stream = io.BytesIO(contents)
+    return contents
 
-    workbook = openpyxl.load_workbook(stream)
+def make_avis(config, dr_config, avis_contents, vehicles, agencies, results_file=None):
+    """ match the avis vehicle report (avis_contents, from fetch_avis) against the DTT vehicles
 
-    return workbook
+        results_file is an optional (file name, 'json' or 'csv') to save the matching results in
+    """
 
-def make_avis(config, dr_config, account, vehicles, agencies):
-    """ fetch the latest avis vehicle report from sharepoint """
+    import openpyxl
 
-    avis_wb = fetch_avis(config, account)
+    avis_open_title, avis_open_columns, avis_open, vehicle_index, results = match_avis(
+            config, dr_config, avis_contents, vehicles, agencies)
 
     output_wb = openpyxl.Workbook()
 
@@ -531,16 +840,14 @@ def make_avis(config, dr_config, account, vehicles, agencies):
     output_ws_open = output_wb.create_sheet(f"DR{ dr_config.dr_id }")
     log.debug(f"sheet names: { output_wb.sheetnames }")
 
-    # we now have the latest file.  Suck out all the data
-    avis_open_title, avis_open_columns, avis_open, avis_open_all = read_avis_sheet(dr_config, avis_wb['Open RA'])
-    add_missing_avis_vehicles(vehicles, avis_open_all, avis_open, closed=False)
-
-    #avis_closed_title, avis_closed_columns, avis_closed, avis_closed_all = read_avis_sheet(dr_config, avis_wb['Closed RA'])
-    #add_missing_avis_vehicles(vehicles, avis_closed_all, avis_closed, closed=True)
-
     # generate the 'Open RA' sheet
     output_columns = copy_avis_sheet(output_ws_open, avis_open_columns, avis_open_title, avis_open)
-    match_avis_sheet(output_ws_open, output_columns, avis_open, vehicles, agencies)
+
+    render_avis_matches(output_ws_open, output_columns, results, vehicle_index, agencies)
+
+    if results_file is not None:
+        file_name, file_format = results_file
+        reconcile.write_results(file_name, avis_open, results, file_format=file_format)
 
     # insert overview at the end
     insert_avis_overview(output_wb, config, dr_config)
@@ -551,10 +858,90 @@ def make_avis(config, dr_config, account, vehicles, agencies):
     return bufferview
 
 
+def match_avis(config, dr_config, avis_contents, vehicles, agencies):
+    """ reconcile this DR's avis 'Open RA' rows against the DTT vehicles.  Doesn't build a workbook.
+
+        Returns (avis_open_title, avis_open_columns, avis_open, vehicle_index, results)
+    """
+
+    avis_tables, avis_rows = load_avis_tables(config, avis_contents)
+
+    # one set of vehicle lookup tables for all the matching stages
+    vehicle_index = reconcile.VehicleIndex(vehicles)
+
+    # we now have the latest file.  Suck out all the data
+    avis_open_title, avis_open_columns, avis_open = read_avis_sheet(dr_config, avis_tables[AVIS_OPEN_SHEET])
+    add_missing_avis_vehicles(dr_config, vehicles, vehicle_index, avis_tables, avis_rows, avis_open)
+
+    # pickup locations resolved in earlier runs are remembered in AGENCY_LOCATIONS_FILE
+    agencies_digest = fingerprint.digest_json(agencies)
+    agency_lookup = agency_index.AgencyIndex(agencies,
+            agency_index.load_locations(config.AGENCY_LOCATIONS_FILE, dr_config.dr_id, agencies_digest))
+    results = reconcile.reconcile_avis_rows(avis_open, vehicle_index, agencies, agency_lookup)
+    if agency_lookup.learned():
+        agency_index.save_locations(config.AGENCY_LOCATIONS_FILE, dr_config.dr_id, agencies_digest,
+                agency_lookup.learned())
+
+    return avis_open_title, avis_open_columns, avis_open, vehicle_index, results
+
+
+
+def load_avis_tables(config, avis_contents):
+    """ parse the sheets of the avis workbook that we use.  Returns ({ sheet name: table }, AvisRowIndex)
+
+        Parsing the workbook is the most expensive part of the avis report, and every DR uses the
+        same national file, so the tables (and the index over their rows) are cached (by content)
+        for the life of the process.  The tables are shared: use read_avis_sheet() to get a per-DR copy.
+    """
+
+    digest = fingerprint.digest_bytes(avis_contents)
+    if digest not in _avis_tables:
+        # the parsed sheets also live in the on-disk table cache, for later runs
+        parsed = table_cache.load(config.TABLE_CACHE_DIR, 'avis', AVIS_PARSER_ID, avis_contents,
+                parse_avis_workbook, digest=digest)
+
+        tables = {}
+        for name, (title_row, avis_columns, avis_all) in parsed.items():
+            rows_by_dr = partition_avis_rows(config, name, avis_all)
+            tables[name] = (title_row, avis_columns, avis_all, rows_by_dr)
+
+        # one index over the open and closed rows, for finding DTT vehicles that aren't in a DR's open rows
+        avis_rows = reconcile.AvisRowIndex( (name, tables[name][2]) for name in AVIS_SHEETS if name in tables )
+
+        _avis_tables[digest] = (tables, avis_rows)
+
+    return _avis_tables[digest]
+
+
+def parse_avis_workbook(avis_contents):
+    """ parse the sheets we use from the avis workbook.  Returns { sheet name: (title_row, avis_columns, avis_all) } """
+
+    import openpyxl
+
+    # read only mode streams the rows and skips the cell styles, which we don't use
+    stream = io.BytesIO(avis_contents)
+    avis_wb = openpyxl.load_workbook(stream, read_only=True)
+
+    try:
+        tables = { AVIS_OPEN_SHEET: parse_avis_sheet(avis_wb[AVIS_OPEN_SHEET]) }
+
+        # the closed sheet is much bigger than the open one, and its rows are only used to fill in
+        # the Open RA output, so keep just the Open RA columns.  A report without it is still usable.
+        try:
+            tables[AVIS_CLOSED_SHEET] = parse_avis_sheet(avis_wb[AVIS_CLOSED_SHEET], titles=set(tables[AVIS_OPEN_SHEET][0]))
+        except Exception as e:
+            log.error(f"could not read the { AVIS_CLOSED_SHEET } sheet; only checking { AVIS_OPEN_SHEET }: { e }")
+
+        return tables
+    finally:
+        avis_wb.close()
+
 
 def workbook_to_buffer(wb):
     """ serialize a workbook to a byte array so it can be saved (either to network or locally) """
 
+    import openpyxl.writer.excel
+
     # cleanup: delete the default sheet name in the output workbook
     default_sheet_name = 'Sheet'
     if default_sheet_name in wb:
@@ -575,6 +962,11 @@ def workbook_to_buffer(wb):
 
 def copy_avis_sheet(ws, columns, title, rows):
     """ copy avis data to the output ws """
+
+    import openpyxl.styles
+    import openpyxl.utils
+    import openpyxl.worksheet.table
+
     wrap_alignment = openpyxl.styles.Alignment(wrapText=True, horizontal='center')
 
     fixed_width_columns = {
@@ -610,7 +1002,6 @@ def copy_avis_sheet(ws, columns, title, rows):
             col += 1
 
     # now add the data
-    time_regex = re.compile(r'(\d{2}):(\d{2}):(\d{2})')
     row = 1
     for row_data in rows:
         row += 1
@@ -635,24 +1026,11 @@ def copy_avis_sheet(ws, columns, title, rows):
             elif key == 'Exp CI Date':
                 time_key = 'Exp CI Time'
 
-            # process date/time column pairs
+            # process date/time column pairs.  The time was folded into the date when the sheet was parsed
             if time_key:
 
-                if isinstance(value, datetime.datetime):
-                    dt = value
-                else:
-                    dt = spreadsheet_tools.excel_to_dt(value)
-
-                    time_string = row_data[time_key]
-                    time_match = time_regex.match(time_string)
-                    if time_match:
-                        interval = datetime.timedelta(hours=int(time_match.group(1)), minutes=int(time_match.group(2)), seconds=int(time_match.group(3)))
-                        dt += interval
-                    else:
-                        log.debug(f"copy_avis_sheet: row { row } time { time_key } didn't parse: '{ time_string }'")
-
-                #log.debug(f"adding row { row } column { col } title { key } value { dt } time_string '{ time_string }'")
-                cell = ws.cell(row=row, column=col, value=dt)
+                #log.debug(f"adding row { row } column { col } title { key } value { value }")
+                cell = ws.cell(row=row, column=col, value=value)
                 cell.number_format = 'yyyy-mm-dd hh:mm'
 
             # don't output time columns: they were already handled
@@ -678,202 +1056,91 @@ def copy_avis_sheet(ws, columns, title, rows):
 
 
 
-def cleanup_v_field(vehicle, field_name):
-    """ do field cleanup for vehicle entries """
-
-    if field_name not in vehicle:
-        return None
-
-    value = vehicle[field_name]
-
-    if value is None:
-        return None
-
-    value = value.strip()
-
-    if field_name == 'RentalAgreementNumber':
-        # rental agreements always start with 'U'; add it if not present
-        if value[0] != 'U':
-            value = 'U' + value
-
-    elif field_name == 'RentalAgreementReservationNumber':
-        # the emailed reservation number looks like 12345678-US-6; put it in cannonical form
-        value = value.replace('-', '').upper()
-
-    elif field_name == 'KeyNumber':
-        # make sure there are 9 digits in the number
-        value = value.rjust(9, '0')
+def add_missing_avis_vehicles(dr_config, vehicles, vehicle_index, avis_tables, avis_rows, avis_open):
+    """ add the active DTT Avis vehicles that aren't in this DR's Open RA rows to avis_open.
 
+        Each of those vehicles is either
+            open:               in another DR's open rows; that row is added (AVIS_SOURCE_OPEN_ALL)
+            closed but active:  only in the closed rows: returned to avis, but still active in the
+                                DTT; the closed row is added (AVIS_SOURCE_CLOSED, or
+                                AVIS_SOURCE_CLOSED_ALL if the row is for another DR)
+            missing:            not in the avis report at all; a row is made up from the DTT
+                                vehicle (AVIS_SOURCE_MISSING)
 
-    return value
-
-
-def make_vehicle_index(vehicles, first_field, second_field=None, reservation=False, keynumber=False):
-
-    #log.debug(f"make_vehicle_index: vehicles len { len(vehicles) }, 1st_field { first_field } 2nd_field { second_field }")
-    result = {}
-    if first_field == 'DisasterVehicleID':
-        for row in vehicles:
-            key = row[first_field]
-            if key in result:
-                log.error(f"Duplicate key { key } in vehicles: old { result[key] } new { row }")
-            else:
-                result[key] = row
-
-    else:
-        for row in vehicles:
-            vehicle = row['Vehicle']
-
-            if first_field not in vehicle:
-                continue
-
-            if second_field is not None and second_field not in vehicle:
-                continue
-
-            key = cleanup_v_field(vehicle, first_field)
-            if key is None:
-                continue
-
-            if second_field is not None:
-                second = vehicle[second_field]
-                if second is None:
-                    continue
-                key = key + " " + second.strip()
-
-            key = key.upper()
-            #log.debug(f"make_vehicle_index: key '{ key }'")
-
-            if key in result:
-                old_row = result[key]
-
-                if old_row['Status'] == 'Active' and row['Status'] == 'Active':
-                    log.error(f"Error: Duplicate rows with key '{ key }' and both are active")
-                    log.info(f"DUPLICATE: key '{ key }' is already in result.\n\nExisting{ result[key] }\n\nnew { row }")
-
-                else:
-                    # at most one row is active
-                    #log.info(f"Error: Duplicate rows with key '{ key }', at most one active "
-                    #        f"(old: '{ old_row['Vehicle']['KeyNumber'] }', "
-                    #        f"new '{ row['Vehicle']['KeyNumber'] }')"
-                    #        )
-
-                    if row['Status'] == 'Active':
-                        # we know that old_row is not active, so use the current row.
-                        result[key] = row
-            else:
-                # first row with this key
-                result[key] = row
-
-    return result
-
-def add_missing_avis_vehicles(vehicles, avis_all, avis_open, closed):
-    """ find Avis vehicles that are not in the Avis report """
-
-    # generate some indexes to look up values faster
-    i_ra  =   spreadsheet_tools.make_index(avis_all, 'Rental Agreement No')
-    i_res =   spreadsheet_tools.make_index(avis_all, 'Reservation No')
-    i_key =   spreadsheet_tools.make_index(avis_all, 'MVA No')
-    i_plate = spreadsheet_tools.make_index(avis_all, 'License Plate State Code', 'License Plate Number')
+        avis_rows is the AvisRowIndex over avis_tables (from load_avis_tables)
+    """
 
-    # note: using avis_open for this index
-    i_row =   spreadsheet_tools.make_index(avis_open, spreadsheet_tools.ROW_INDEX)
+    # this DR's rows in each sheet
+    dr_rows = dict( (name, set(table[3].get(dr_config.dr_id, ()))) for name, table in avis_tables.items() )
 
-    # this is duplicating work in match_avis_sheet, but it doesn't seem worth it to save the info
-    v_ra = make_vehicle_index(vehicles, 'RentalAgreementNumber')
-    v_res= make_vehicle_index(vehicles, 'RentalAgreementReservationNumber')
-    v_key = make_vehicle_index(vehicles, 'KeyNumber')
-    v_plate = make_vehicle_index(vehicles, 'PlateState', 'Plate')
+    # (sheet, position) of the rows already in avis_open
+    added = set( (AVIS_OPEN_SHEET, position) for position in dr_rows[AVIS_OPEN_SHEET] )
 
     missing = []
+    counts = { AVIS_SOURCE_OPEN_ALL: 0, AVIS_SOURCE_CLOSED: 0, AVIS_SOURCE_CLOSED_ALL: 0, AVIS_SOURCE_MISSING: 0 }
 
 
     # walk through the avis_open sheet and record all the matches
     for row in avis_open:
-
-        ra = row['Rental Agreement No']
-        res = row['Reservation No']
-        key = row['MVA No']
-        plate = row['License Plate State Code'] + ' ' + row['License Plate Number']
-        addr_line_3 = row['Address Line 3']
-
-        # use DisasterVehicleID as the DTT identity for a vehicle
-        ra_id = get_dtt_id(v_ra, ra)
-        res_id = get_dtt_id(v_res, res)
-        key_id = get_dtt_id(v_key, key)
-        plate_id = get_dtt_id(v_plate, plate)
-        
+        vehicle_index.find_avis_row(row)
         row[AVIS_SOURCE] = AVIS_SOURCE_OPEN
 
 
-    # get_dtt_id() records which vehicles were looked up.  Add vehicles in DTT that are not in AVIS
+    # vehicle_index records which vehicles were looked up.  Add vehicles in DTT that are not in AVIS
     for record in vehicles:
         # vehicle is not active
         if record['Status'] != 'Active':
             continue
 
         # already in the Avis report
-        if IN_AVIS in record:
+        if vehicle_index.in_avis(record):
             continue
 
         # make sure its an Avis rental
-        if record['Vehicle']['Vendor'] != 'Avis':
+        if record.Vehicle.Vendor != 'Avis':
             continue
 
-        # see if this vehicle is in avis_all
-        vehicle = record['Vehicle']
+        vehicle = record.Vehicle
 
         if vehicle['KeyNumber'] is None:
             # don't bother if there is no key number: its just a reservation
             continue
 
-        ra = cleanup_v_field(vehicle, 'RentalAgreementNumber')
-        res = cleanup_v_field(vehicle, 'RentalAgreementReservationNumber')
-        key = cleanup_v_field(vehicle, 'KeyNumber')
-        plate = f"{ vehicle['PlateState'] } { vehicle['Plate'].strip() }"
-
-        if vehicle['Plate'] == "812KBK":
-            log.debug(f"saw vehicle 812KBK")
-
-        if ra in i_ra or res in i_res or key in i_key or plate in i_plate:
-
-            #log.debug(f"Adding missing vehicle to OPEN { key }")
-
-            # one or more fields from the DTT appeared in the avis_all list, but not the avis_open list.
-            # add the row to the avis_open  list
-            new_avis_records = []
-            if ra in i_ra:
-                new_avis_records.append(i_ra[ra])
-            if res in i_res:
-                new_avis_records.append(i_res[res])
-            if key in i_key:
-                new_avis_records.append(i_key[key])
-            if plate in i_plate:
-                new_avis_records.append(i_plate[plate])
-
-            # add any records to avis_open that we don't already have
-            for row in new_avis_records:
-                row_index = row[spreadsheet_tools.ROW_INDEX]
-                if row_index not in i_row:
-                    # this row isn't in avis_open yet...
-                    row[AVIS_SOURCE] = AVIS_SOURCE_OPEN_ALL
-                    avis_open.append(row)
-                    i_row[row_index] = row
+        # one or more fields from the DTT appear in the avis report, but not in this DR's open rows.
+        # An open rental anywhere wins over closed ones.
+        found = avis_rows.find_vehicle(vehicle)
+        if len(found) > 0:
+            best_sheet = found[0][0]
+            for sheet_name, position in found:
+                if sheet_name != best_sheet or (sheet_name, position) in added:
+                    continue
 
-        else:
-            # ZZZ: need to check closed roster before adding missing vehicles...
-            if True:
-                # this is an entirely new vehicle that doesn't match anything in avis_all
-                #log.debug(f"Adding missing vehicle to ALL { key }")
+                added.add((sheet_name, position))
 
-                row = make_avis_from_vehicle(record)
-                row[AVIS_SOURCE] = AVIS_SOURCE_MISSING
-                row[spreadsheet_tools.ROW_INDEX] = len(avis_all) + 1
-                missing.append(row)
+                in_dr = position in dr_rows[sheet_name]
+                if sheet_name == AVIS_OPEN_SHEET:
+                    source = AVIS_SOURCE_OPEN_ALL
+                else:
+                    source = AVIS_SOURCE_CLOSED if in_dr else AVIS_SOURCE_CLOSED_ALL
 
+                row = dict(avis_tables[sheet_name][2][position])
+                row[AVIS_SOURCE] = source
+                avis_open.append(row)
+                counts[source] += 1
+
+        else:
+            # this is an entirely new vehicle that doesn't match anything in the avis report
+            row = make_avis_from_vehicle(record)
+            row[AVIS_SOURCE] = AVIS_SOURCE_MISSING
+            missing.append(row)
+            counts[AVIS_SOURCE_MISSING] += 1
+
+    log.debug(f"added to the open rows: { counts[AVIS_SOURCE_OPEN_ALL] } open for other DRs, "
+            f"{ counts[AVIS_SOURCE_CLOSED] + counts[AVIS_SOURCE_CLOSED_ALL] } closed but active in the DTT, "
+            f"{ counts[AVIS_SOURCE_MISSING] } not in the avis report")
 
     # add the missing rows to the end
     avis_open.extend(missing)
-    avis_all.extend(missing)
 
 
 def make_avis_from_vehicle(record):
@@ -883,7 +1150,7 @@ def make_avis_from_vehicle(record):
 
     def get_field(name):
         """ utility function to safely get field values """
-        value = cleanup_v_field(vehicle, name)
+        value = reconcile.cleanup_v_field(vehicle, name)
         if value is None:
             return ""
         return value
@@ -909,30 +1176,14 @@ def make_avis_from_vehicle(record):
         avis[f_avis] = get_field(f_vehicle)
 
     # strip off the timezone; openpyxl can't write it
-    pickupDate = re.sub(r'-\d\d:\d\d$', '', get_field('RentalAgreementPickupDate'))
-    avis['CO Date'] = datetime.datetime.fromisoformat(pickupDate)
+    pickup_dt = vehicle.pickup_dt
+    avis['CO Date'] = pickup_dt.replace(tzinfo=None) if pickup_dt is not None else None
 
     #log.debug(f"new avis record: { avis }")
     return avis
 
 
 
-def get_dtt_id(vehicle_dict, index):
-    """ utility function to look up a field in the vehicle object from the DTT """
-
-    index = index.upper()
-    if index not in vehicle_dict:
-        return None
-
-    # mark the vehicle as found-in-avis-report
-    vehicle_dict[index][IN_AVIS] = True
-
-    #log.debug(f"index { index } v_dict { vehicle_dict[index] }")
-    return vehicle_dict[index]['DisasterVehicleID']
-
-
-
-STRIKE_FONT = openpyxl.styles.Font(strike=True)
 def mark_cell(ws, fill, v_id, vid, row_num, col_map, col_name, comment=None):
     """ apply a fill to a particular cell
 
@@ -940,6 +1191,8 @@ def mark_cell(ws, fill, v_id, vid, row_num, col_map, col_name, comment=None):
         vid is the vehicle id number
     """
 
+    from workbook_styles import STRIKE_FONT
+
     col_num = col_map[col_name]
 
     cell = ws.cell(row=row_num, column=col_num)
@@ -951,7 +1204,7 @@ def mark_cell(ws, fill, v_id, vid, row_num, col_map, col_name, comment=None):
         cell.comment = comment
 
     if v_id is not None and vid is not None:
-        status = v_id[vid]['Status']
+        status = v_id[vid].Status
         if status != 'Active':
             #log.debug(f"inactive vehicle found: { vid } status '{ status }'")
             cell.font = STRIKE_FONT
@@ -978,425 +1231,144 @@ def make_agency_key(agency):
     key = agency_key_fixup_space.sub(' ', key)
     return key
 
-dtt_to_avis_make_dict = {
-        'Buick': 'BUIC',
-        'Chevrolet': 'CHEV',
-        'Chrysler': 'CHRY',
-        'Dodge': 'DODG',
-        'Ford': 'FORD',
-        'GMC': 'GMC ',
-        'Honda': 'HOND',
-        'Hyundai': 'HYUN',
-        'Jeep': 'JEEP',
-        'Kia': 'KIA ',
-        'Lincoln': 'LINC',
-        'Mazda': 'MAZD',
-        'Mitsubishi': 'MITS',
-        'Nissan': 'NISS',
-        'Subaru': 'SUBA',
-        'Toyota': 'TOYO',
-        'Volkswagen': 'VOLK',
-        'Volvo': 'VOLV',
-        }
-dtt_to_avis_model_dict = {
-        '3': '3SED',
-        '300': '300M',
-        '4Runner': '4RUN',
-        '6': '6SED',
-        'Acadia': 'ACA2',
-        'Accord': 'ACCO',
-        'Altima': 'ALTI',
-        'Atlas': [ 'ATLF', 'ATLA', ],
-        'Blazer': [ 'BLZ4', 'BLZ2', ],
-        'Bronco': [ 'BRSP', 'BRO4', ],
-        'Cadenza': 'K5K5',
-        'Carnival': 'CRVL',
-        'Camaro': [ 'CMRO', 'CAML' ],
-        'Camry': [ 'CAMR', 'CMHY' ],
-        'Caravan': 'GRCA',
-        'Celica': 'CHRF',
-        'Charger': 'CHAR',
-        'Civic': 'CIVI',
-        'Cherokee': 'CHEA',
-        #'CJ': 'GLH4',  # wrong association?  Moved to Gladiator
-        'Colorado': 'COL4',
-        'Compass': 'CMPS',
-        'Corolla': 'CRLA',
-        'CR-V': 'CRV4',
-        'CX-3': 'C30A',
-        'CX-30': 'C30A',
-        'CX-5': 'CX5A',
-        'CX-50': 'C50A',
-        'CX-9': 'CX9F',
-        'CX-90': 'C90A',
-        'Durango': 'DURA',
-        'Eclipse': 'ECCF',
-        'Econoline': 'ECOA',
-        'Ecosport': 'ECOF',
-        'Edge': [ 'EDE2', 'EDE4' ],
-        'Elantra': 'ELAN',
-        'Encore': [ 'ENCA', 'EGXF', 'EGXA' ],
-        'Enclave': 'ENCL',
-        'Envision': 'ENVI',
-        'Equinox': 'EQUI',
-        'Escape': [ 'ESCA', 'ESC2' ],
-        'Expedition': 'EXL4',
-        'Explorer': 'EXL2',
-        'Express - 12 Pass': 'EX12',
-        'Express - 15 Pass': 'EX15',
-        'F-150': 'F150',
-        'Forester': 'FORE',
-        'Forte': 'FORT',
-        'Frontier': 'FRO4',
-        'Fusion': 'FUSI',
-        'Gladiator': 'GLH4',
-        'Golf': 'GOLF',
-        'Grand Cherokee': 'GRCH',
-        'Highlander': 'HIGH',
-        'Hornet PREV AWD': 'HORA',
-        'Hornet PHEV AWD': 'HORA',
-        'HR-V': [ 'HRVA', ],
-        'Impreza': 'IMPW',
-        'IONIQ': 'IEVA',
-        'Jetta': 'JETT',
-        'Journey': 'JOU2',
-        'K4': 'K4K4',
-        'K5': 'K5K5',
-        'Kona': 'KONF',
-        'Legacy': 'LEGA',
-        'Kicks': 'KICF',
-        'Malibu': 'MALB',
-        'MKZ': ' MKZ',      # lincoln MKZ midsize sedan
-        'Murano': 'MUR2',
-        'Mustang': [ 'MUST', 'MUSC' ],
-        'MX-30': 'C30A',
-        'Niro': 'NIRH',
-        'Odyssey': [ 'ODYA', 'ODYS', ],
-        'Optima': 'OPTI',
-        'Outback': 'OUTB',
-        'Outlander': 'OUTL',
-        'Pacifica': [ 'PACI', 'PACH', ],
-        'Palisade': 'PAL4',
-        'Passat': 'PASS',
-        'Pathfinder': 'PATH',
-        'Pilot': 'PILA',
-        'Prius': 'PRIH',
-        'RAM': [ 'RAR2', 'RAC4', 'QUA4', ],
-        'Ranger': 'RAN4',
-        'RAV 4': [ 'RAV4', 'RAVH', 'RAV2' ],
-        'Ridgeline': 'RID4',
-        'Rio': 'RIO',
-        'Rogue': [ 'ROG2', 'ROGU' ],
-        'Santa Fe': 'SANT',
-        'Sedona': 'SEDO',
-        'Sentra': 'SENT',
-        'Sequoia': 'SEH4',
-        'Sienna': 'SIEN',
-        'Sierra': 'SIRA',
-        'Silverado': 'SILV',
-        'Sonata': 'SONA',
-        'Sorento': [ 'SO7F', 'SO74', ],
-        'Soul': 'SOUL',
-        'Spark': 'SPRK',
-        'Sportage': [ 'SPO2', 'SPOR' ],
-        'Suburban': 'SUB2',
-        'Tacoma': 'TAC4',
-        'Tahoe': [ 'TAHO', 'TAH2' ],
-        'Taos': 'TAO4',
-        'Telluride': 'TEL4',
-        'Terrain': 'TERR',
-        'Tiguan': 'TIG2',
-        'Tracker': 'TRX2',
-        'TrailBlazer': [ 'TRBA', 'BLZ2', ],
-        'Transit': 'TR15',
-        'Traverse': 'TRAV',
-        'Trax': 'TRX2',
-        'Tucson': [ 'TUCS', 'TUHA' ],
-        'Versa': 'VRSA',       
-        'Voyager': 'VGER',
-        'Wrangler': [ 'WRA4', 'WRPH' ],
-        'V60': 'V60A',
-        'XV Crosstrex': 'XVCR',
-        'Venue': 'VENF',
-        'Yukon': 'YUS4',
-        }
-dtt_to_avis_color_dict = {
-        'Silver': 'SIL',
-        'White': 'WHI',
-        'Blue': 'BLU',
-        'Black': 'BLK',
-        'Gray': 'GRY',
-        'Red': 'RED',
-        'Brown': 'BRO',
-        'Green': 'GRN',
-        }
-
-def dtt_to_avis_make(make_tuple, avis_tuple):
-    """ convert DTT make/model/color to avis """
-
-    make = None
-    model  = None
-    color = None
-
-    if make_tuple[0] in dtt_to_avis_make_dict:
-        make = dtt_to_avis_make_dict[make_tuple[0]]
-    else:
-        log.debug(f"could not find make '{ make_tuple[0] }' / avis '{ avis_tuple[0] }'")
-        
-    if make_tuple[1] in dtt_to_avis_model_dict:
-        model = dtt_to_avis_model_dict[make_tuple[1]]
-    else:
-        log.debug(f"could not find model '{ make_tuple[1] }' / avis '{ avis_tuple[1] }'")
-
-    if make_tuple[2] in dtt_to_avis_color_dict:
-        color = dtt_to_avis_color_dict[make_tuple[2]]
-    else:
-        # avis does't have Yellow and Beige in its list of colors
-        if make_tuple[2] != 'Yellow' and make_tuple[2] != 'Beige' and make_tuple[2] != 'UNK':
-            log.debug(f"could not find color '{ make_tuple[2] }' / avis '{ avis_tuple[2] }'")
-
-
-    return (make, model, color)
-
-def match_avis_sheet(ws, columns, avis, vehicles, agencies):
-    """ match entries from the DTT to entries in the Avis report. """
+def render_avis_matches(ws, columns, results, vehicle_index, agencies):
+    """ color and comment the avis sheet according to the reconciliation results (from reconcile.reconcile_avis_rows) """
 
-    # generate different index for the vehicles
-    v_ra = make_vehicle_index(vehicles, 'RentalAgreementNumber')
-    v_res= make_vehicle_index(vehicles, 'RentalAgreementReservationNumber')
-    v_key = make_vehicle_index(vehicles, 'KeyNumber')
-    v_plate = make_vehicle_index(vehicles, 'PlateState', 'Plate')
-    v_id = make_vehicle_index(vehicles, 'DisasterVehicleID')
+    from openpyxl.comments import Comment
+    from workbook_styles import FILL_RED, FILL_GREEN, FILL_YELLOW, FILL_BLUE, FILL_CYAN, FILL_GRAY
 
-    vid_dict = dict( (v['DisasterVehicleID'], v) for v in vehicles)
+    v_id = vehicle_index.by_id
 
-    #log.debug(f"plate keys: { v_plate.keys() }")
+    def describe_vehicle(vid):
+        vrow = v_id[vid]
+        veh = vrow.Vehicle
 
-    multispace_re = re.compile(r'\s+')
+        return (f"DTT id { vid } -- status { vrow.Status }\n"
+                f"Driver { get_current_driver(veh) }\n"
+                f"Key { veh.KeyNumber }\n"
+                f"Reservation { veh.RentalAgreementReservationNumber }\n"
+                f"Agreement { veh.RentalAgreementNumber }\n"
+                f"Plate { veh.PlateState } { veh.Plate }\n")
 
-    #log.debug(f"make translation dict: { dtt_to_avis_model_dict }")
-    agency_no_match_list = {}
-
-    def mark_cell_wrapper(vid, field_name, spreadsheet_row, columns, column_name):
+    def mark_cell_wrapper(vid, spreadsheet_row, column_name, suggestion=None):
         if vid is None:
             fill = FILL_RED
             comment = None
+
+            if suggestion is not None:
+                # not in the DTT, but close to a DTT value: probably a typo
+                comment = Comment(
+                        f"Not in DTT.  Closest DTT value is { suggestion['value'] } "
+                        f"({ suggestion['distance'] } character{ '' if suggestion['distance'] == 1 else 's' } different)\n"
+                        + describe_vehicle(suggestion['vehicle_id'])
+                        , COMMENT_AUTHOR, height=300, width=400)
         else:
             fill = FILL_YELLOW
-            vrow = vid_dict[vid]
-            veh = vrow['Vehicle']
-            veh_value = veh[field_name]
-
-            comment = Comment(
-                    f"DTT id { vid } -- status { vrow['Status'] }\n"
-                    f"Driver { get_current_driver(veh) }\n"
-                    f"Key { veh['KeyNumber'] }\n"
-                    f"Reservation { veh['RentalAgreementReservationNumber'] }\n"
-                    f"Agreement { veh['RentalAgreementNumber'] }\n"
-                    f"Plate { veh['PlateState'] } { veh['Plate'] }\n"
-                    , COMMENT_AUTHOR, height=300, width=400)
+            comment = Comment(describe_vehicle(vid), COMMENT_AUTHOR, height=300, width=400)
 
         mark_cell(ws, fill, v_id, vid, spreadsheet_row, columns, column_name, comment=comment)
 
     spreadsheet_row = 1
-    for row in avis:
+    for result in results:
         spreadsheet_row += 1
 
-        ra = row['Rental Agreement No']
-        res = row['Reservation No']
-        key = row['MVA No']
-        plate = row['License Plate State Code'] + ' ' + row['License Plate Number']
-        cost_control = row['Cost Control No']
-
-        if plate == "WA BOS5423":
-            log.debug(f"saw avis plate { plate }")
-
-        if cost_control == 'MISSING':
-            # this is a synthetic row created from the DTT, not AVIS; don't bother matching
+        match = result['match']
+        if match == reconcile.MATCH_SYNTHETIC:
             continue
 
-        addr_line = ''
-        if 'Address Line 1' in row and 'Address Line 3' in row:
-            addr_line = f"{ row['Address Line 1'] }/{ row['Address Line 3'] }"
-            addr_line = multispace_re.sub(' ', addr_line)
-
-        # use DisasterVehicleID as the DTT identity for a vehicle
-        ra_id = get_dtt_id(v_ra, ra)
-        res_id = get_dtt_id(v_res, res)
-        key_id = get_dtt_id(v_key, key)
-        plate_id = get_dtt_id(v_plate, plate)
-
-        #log.debug(f"ra { ra_id } res { res_id } key { key_id } plate { plate_id }; raw { ra } { res } { key } { plate }")
-
-        if AVIS_SOURCE in row:
-            avis_source = row[AVIS_SOURCE]
-        else:
-            avis_source = None
+        ids = result['ids']
+        plate_id = ids['plate']
+        avis_source = result['source']
 
-        if ra_id == None and res_id == None and key_id == None and plate_id == None:
-            # vehicle doesn't appear in the DTT at all; color it blue
-            fill = FILL_BLUE
-
-            if avis_source == AVIS_SOURCE_OPEN_ALL:
-                fill = FILL_CYAN
-
-            mark_cell(ws, fill, v_id, ra_id,    spreadsheet_row, columns, 'Rental Agreement No')
-            mark_cell(ws, fill, v_id, res_id,   spreadsheet_row, columns, 'Reservation No')
-            mark_cell(ws, fill, v_id, key_id,   spreadsheet_row, columns, 'MVA No')
-            mark_cell(ws, fill, v_id, plate_id, spreadsheet_row, columns, 'License Plate State Code')
-            mark_cell(ws, fill, v_id, plate_id, spreadsheet_row, columns, 'License Plate Number')
-
-        elif ra_id == res_id and ra_id == key_id and ra_id == plate_id:
-            # all columns match: color it green
-
-            fill = FILL_GREEN
-
-            #if avis_source == AVIS_SOURCE_OPEN_ALL:
-            #    fill = FILL_CYAN
+        if match == reconcile.MATCH_NONE or match == reconcile.MATCH_ALL:
+            if match == reconcile.MATCH_NONE:
+                # vehicle doesn't appear in the DTT at all; color it blue
+                fill = FILL_CYAN if avis_source == AVIS_SOURCE_OPEN_ALL else FILL_BLUE
+            else:
+                # all columns match: color it green
+                fill = FILL_GREEN
 
-            mark_cell(ws, fill, v_id, ra_id,    spreadsheet_row, columns, 'Rental Agreement No')
-            mark_cell(ws, fill, v_id, res_id,   spreadsheet_row, columns, 'Reservation No')
-            mark_cell(ws, fill, v_id, key_id,   spreadsheet_row, columns, 'MVA No')
+            for index_name, column_name in reconcile.ID_COLUMNS:
+                mark_cell(ws, fill, v_id, ids[index_name], spreadsheet_row, columns, column_name)
             mark_cell(ws, fill, v_id, plate_id, spreadsheet_row, columns, 'License Plate State Code')
-            mark_cell(ws, fill, v_id, plate_id, spreadsheet_row, columns, 'License Plate Number')
 
-            # since all four 'unique' fields match: check additional fields
-            vrow = vid_dict[ra_id]
-            vehicle = vrow['Vehicle']
+        if match == reconcile.MATCH_ALL:
 
             # check 'agency' (aka pickup location)
-            agency_key = vehicle['PickupAgencyId']
-            if agency_key not in agencies:
-                log.debug(f"could not find agency key '{ agency_key }' in v_agencies ")
-            else:
-                agency = agencies[agency_key]
-                agency_string = agency['AvisAgencyString']
+            agency_result = result['agency']
+            if agency_result is not None:
                 comment = None
 
-                if agency_string == addr_line:
+                if agency_result['match']:
                     fill = FILL_GREEN
                 else:
                     fill = FILL_YELLOW
-                    if agency_string not in agency_no_match_list:
-                        # only print once per agency
-                        log.debug(f"no agency match '{ addr_line }' / '{ agency_string }'")
-                        agency_no_match_list[agency_string] = True
+                    agency = agencies[agency_result['agency_id']]
 
-                    comment = Comment(
-                            f"DTT location is:\n"
+                    text = (f"DTT location is:\n"
                             f"{ agency['Name'] }\n"
                             f"{ agency['Address'] }\n"
-                            f"{ agency['City'] } { agency['State'] } { agency['Zip'] }",
-                            COMMENT_AUTHOR, height=300, width=400)
+                            f"{ agency['City'] } { agency['State'] } { agency['Zip'] }")
+                    if agency_result['resolved']:
+                        text += "\nAvis location is DTT " + ' / '.join(agencies[a]['Name'] for a in agency_result['resolved'])
+                    comment = Comment(text, COMMENT_AUTHOR, height=300, width=400)
 
                 mark_cell(ws, fill, None, None, spreadsheet_row, columns, 'Rental Loc Desc', comment=comment)
                 mark_cell(ws, fill, None, None, spreadsheet_row, columns, 'Address Line 1')
                 mark_cell(ws, fill, None, None, spreadsheet_row, columns, 'Address Line 3')
 
-
             # check pickup and expected dropoff date
-            for (dtt_col, avis_col) in (('RentalAgreementPickupDate', 'CO Date'), ('DueDate', 'Exp CI Date')):
-                raw_date = vehicle[dtt_col]
-                dtt_date = None
-                try:
-                    dtt_date = datetime.datetime.fromisoformat(vehicle[dtt_col]).date()
-                except TypeError as e:
-                    log.error(f"could not convert '{ raw_date }' from field { dtt_col } to a date for vehicle key { vehicle['KeyNumber'] }", e)
-
-                col_num = columns[avis_col]
-                cell = ws.cell(row=spreadsheet_row, column=col_num)
-
-                avis_pickup_dt = cell.value
-
-                if avis_pickup_dt != None:
-
-                    avis_pickup_date = avis_pickup_dt.date()
-
-                    if dtt_date == avis_pickup_date:
-                        fill = FILL_GREEN
-                    else:
-                        #log.debug(f"pickup date: key { key } dtt { dtt_date }/{vehicle[dtt_col]} avis { avis_pickup_date }/{ avis_pickup_dt }")
-                        fill = FILL_YELLOW
-                        cell.comment = Comment(f"DTT date is { dtt_date }", COMMENT_AUTHOR, height=300, width=400)
-
-                    cell.fill = fill
+            for date_result in result['dates']:
+                comment = None
+                if date_result['match']:
+                    fill = FILL_GREEN
+                else:
+                    fill = FILL_YELLOW
+                    comment = Comment(f"DTT date is { date_result['dtt'] }", COMMENT_AUTHOR, height=300, width=400)
 
+                mark_cell(ws, fill, None, None, spreadsheet_row, columns, date_result['column'], comment=comment)
 
             # check make/model/color
-            avis_make_cols = ['Make', 'Model', 'Ext Color Code']
-            avis_veh_make = list(row[col_name] for col_name in avis_make_cols)
-            #avis_veh_make = (row['Make'], row['Model'], row['Ext Color Code'])
-            dtt_veh_make_orig = (vehicle['Make'].strip() if vehicle['Make'] != None else None,
-                    vehicle['Model'].strip() if vehicle['Model'] != None else None,
-                    vehicle['Color'].strip() if vehicle['Color'] != None else None)
-            dtt_veh_make = dtt_to_avis_make(dtt_veh_make_orig, avis_veh_make)
-
-            #log.debug(f"avis make {  avis_veh_make } dtt { dtt_veh_make } orig { dtt_veh_make_orig }")
-
-            for (i, col_name) in enumerate(avis_make_cols):
-                v = dtt_veh_make[i]
-
+            for make_result in result['make']:
                 fill = None
                 comment = None
 
-                if v is None:
+                if make_result['mapped'] is None:
                     # DTT string not found in our mapping table; ignore
-                    comment = Comment(f"No mapping for DTT value { dtt_veh_make_orig[i] }", COMMENT_AUTHOR, height=300, width=400)
-
+                    comment = Comment(f"No mapping for DTT value { make_result['dtt'] }", COMMENT_AUTHOR, height=300, width=400)
+                elif make_result['match']:
+                    fill = FILL_GREEN
                 else:
+                    fill = FILL_YELLOW
+                    text = f"DTT value is { make_result['dtt'] } -> { ' / '.join(make_result['mapped']) }"
+                    if make_result.get('avis_means'):
+                        text += f"\nAvis code is DTT { ' / '.join(make_result['avis_means']) }"
+                    comment = Comment(text, COMMENT_AUTHOR, height=300, width=400)
 
-                    if i == 1:
-                        #log.info(f"vehicle make { v } type { type(v) }")
-                        pass
-
-                    if type(v) == list:
-                        #log.info(f"vehicle make list check { v } type { type(v) }")
-                        # list of possible string matches
-                        for possible_match in v:
-                            #log.info(f"checking values: i { i } v { v } possible_match { possible_match }")
-                            if possible_match == avis_veh_make[i]:
-                                fill = FILL_GREEN
-                                break
-                    else:
-                        # single string value
-                        if v == avis_veh_make[i]:
-                            fill = FILL_GREEN
-
-                    if fill == None:
-                        fill = FILL_YELLOW
-                        comment = Comment(f"DTT value is { dtt_veh_make_orig[i] } -> { v }", COMMENT_AUTHOR, height=300, width=400)
-
-                mark_cell(ws, fill, None, None, spreadsheet_row, columns, col_name, comment=comment)
-            
+                mark_cell(ws, fill, None, None, spreadsheet_row, columns, make_result['column'], comment=comment)
 
-        else:
+        elif match == reconcile.MATCH_PARTIAL:
             # else color yellow if value is found; red if value not found
-            mark_cell_wrapper(ra_id, 'RentalAgreementNumber', spreadsheet_row, columns, 'Rental Agreement No')
-            mark_cell_wrapper(res_id, 'RentalAgreementReservationNumber', spreadsheet_row, columns, 'Reservation No')
-            mark_cell_wrapper(key_id, 'KeyNumber', spreadsheet_row, columns, 'MVA No')
-            mark_cell_wrapper(plate_id, 'Plate', spreadsheet_row, columns, 'License Plate Number')
+            suggestions = result['suggestions']
+            for index_name, column_name in reconcile.ID_COLUMNS:
+                mark_cell_wrapper(ids[index_name], spreadsheet_row, column_name, suggestion=suggestions.get(index_name))
 
             mark_cell(ws, FILL_RED if plate_id is None else FILL_YELLOW, v_id, plate_id, spreadsheet_row, columns, 'License Plate State Code')
 
         if avis_source == AVIS_SOURCE_OPEN_ALL:
             mark_cell(ws, FILL_YELLOW, None, None, spreadsheet_row, columns, 'Cost Control No')
+        elif avis_source == AVIS_SOURCE_CLOSED or avis_source == AVIS_SOURCE_CLOSED_ALL:
+            comment = Comment("Returned to Avis (on the Closed RA sheet) but still Active in the DTT", COMMENT_AUTHOR, height=300, width=400)
+            mark_cell(ws, FILL_GRAY, None, None, spreadsheet_row, columns, 'Cost Control No', comment=comment)
         elif avis_source == AVIS_SOURCE_MISSING or avis_source is None:
             mark_cell(ws, FILL_CYAN, None, None, spreadsheet_row, columns, 'Cost Control No')
 
 
-
-
-
-
-        
-
-
-
-
-
 def insert_avis_overview(wb, config, dr_config):
     """ insert an overview (documentation) sheet in the workbook """
 
+    from workbook_styles import FILL_RED, FILL_GREEN, FILL_YELLOW, FILL_BLUE, FILL_CYAN, FILL_GRAY
+
     doc_string = f"""
 This document has vehicles from the daily Avis report for this DR ({ dr_config.dr_id }).
 
@@ -1412,11 +1384,15 @@ If a vehicle in the Avis report is not found in the DTT: the cells will be blue.
 
 If all four fields don't match: any field that is not found in the DTT will be red.
 Otherwise the fields will be yellow.  Red fields are usually typos in the DTT data entry.
+If a red field is within a character or two of a DTT value, its comment shows the closest DTT vehicle.
 A row of all yellow often means a data entry error where fields from different vehicles were
 entered on the same DTT entry.
 
 Cyan fields are used when a vehicle is in the DTT but not in the Avis report.
 
+A gray 'Cost Control No' marks a rental that is on the Avis Closed RA sheet (the car was returned)
+but is still Active in the DTT.  These vehicles probably need to be released in the DTT.
+
 If the MVA, Reservation, Contract, or Plate fields use strike-through fonts: the vehicle is released
 in the DTT but active in the Avis report.
 
@@ -1443,6 +1419,8 @@ This file generated at { TIMESTAMP }
     cell.fill = FILL_BLUE
     cell = ws.cell(row=6, column=1, value="Example Cyan cell")
     cell.fill = FILL_CYAN
+    cell = ws.cell(row=7, column=1, value="Example Gray cell")
+    cell.fill = FILL_GRAY
 
     return ws
 
@@ -1483,6 +1461,8 @@ This file generated at { TIMESTAMP }
 
 def insert_overview(wb, doc_string):
 
+    import openpyxl.styles
+
     ws = wb.create_sheet('Overview')
 
     ws.column_dimensions['A'].width = 120       # hard coded width....
@@ -1493,123 +1473,177 @@ def insert_overview(wb, doc_string):
 
     return ws
 
-def read_avis_sheet(dr_config, sheet):
+def parse_avis_sheet(sheet, titles=None):
+    """ convert an avis sheet to (title_row, avis_columns, avis_all)
 
-    #log.debug(f"sheet name { sheet.name }")
+        The rows are streamed from a read only worksheet.  Only columns with a title are kept:
+        those are the ones copy_avis_sheet and the matching code can refer to.  If titles is given,
+        only the columns with those titles are kept.
+    """
 
-    #log.debug(f"last_column { sheet.max_column } last_row { sheet.max_row }")
+    from neil_tools import spreadsheet_tools
 
-    # convert all the cell values into a list (of rows) and list (of cell values)
-    values = list(sheet.iter_rows(min_col=2, values_only=True))
+    #log.debug(f"sheet name { sheet.title }")
 
-    #log.debug(f"values is { values }")
+    # the dimensions recorded in the file aren't always right; read until the data runs out
+    sheet.reset_dimensions()
+    rows = sheet.iter_rows(min_col=2, values_only=True)
 
     # sometimes the Open RA sheet has the title row in different places.  Look for the title row in the first few rows
     # Note: this depends on the 2nd column not being renamed (Rental Region Desc)
 
     title_value = 'Rental Region Desc'
     rows_to_search = 5
-    rows_to_skip = None
+    title_row = None
 
-    for i in range(rows_to_search):
-        if values[i][0] == title_value:
+    for i, values in enumerate(itertools.islice(rows, rows_to_search)):
+        if len(values) > 0 and values[0] == title_value:
             # we found the title row
-            rows_to_skip = i
+            title_row = values   # column headers
+            break
 
-    if rows_to_skip is None:
+    if title_row is None:
         raise(Exception("Could not find title row in Avis spreadsheet"))
 
-    for i in range(rows_to_skip):
-        values.pop(0)
-
-    title_row = values[0]   # column headers
+    # project each row down to the titled columns
+    keep = [ i for i, value in enumerate(title_row) if value is not None and value != '' and (titles is None or value in titles) ]
+    title_row = [ title_row[i] for i in keep ]
+    width = keep[-1] + 1 if len(keep) > 0 else 0
 
+    values = [ title_row ]
+    for row in rows:
+        if len(row) < width:
+            row = row + (None,) * (width - len(row))
+        values.append([ row[i] for i in keep ])
 
-    #title_row = values[0]
-
-    #log.debug(f"1st row { values[0][1] }")
-    #log.debug(f"2nd row { values[1][1] }")
-    #log.debug(f"3rd row { values[2][1] }")
-    #log.debug(f"4th row { values[3][1] }")
-    #log.debug(f"5th row { values[4][1] }")
+    #log.debug(f"rows: { len(values) - 1 } title_row { title_row }")
 
     avis_columns = spreadsheet_tools.title_to_dict(title_row)
     avis_all = spreadsheet_tools.matrix_to_object_array(values)
+    reconcile.normalize_avis_dates(avis_all)
     #log.debug(f"avis_all: { avis_all }")
 
-    # filter out None values from title row
-    title_row = filter(lambda value: value is not None, title_row)
-    #log.debug(f"rows_to_skip: { rows_to_skip } title_row { title_row }")
+    return title_row, avis_columns, avis_all
+
+
+def read_avis_sheet(dr_config, avis_table):
+    """ pick the rows for this DR out of a parsed avis sheet (from load_avis_tables)
+
+        The rows are copied: the report stages annotate and extend them, and the parsed table is
+        shared by all the DRs.
+    """
+
+    title_row, avis_columns, avis_all, rows_by_dr = avis_table
+
+    avis_dr = [ dict(avis_all[i]) for i in rows_by_dr.get(dr_config.dr_id, []) ]
+    log.debug(f"found { len(avis_dr) } vehicles associated with the DR\n\n")
+
+    return list(title_row), avis_columns, avis_dr
+
 
+# the DR number format (in the 'Cost Control No' column) isn't well controlled.
+# trying to match patterns like:
+# 98, 098, DR098, DR098-21, DR098-2021, 098-21, etc...
+cost_control_re = re.compile(r"\s*(dr)?\s*0*(\d+)(-(20)?(\d\d))?\b", flags=re.IGNORECASE)
+
+def parse_cost_control(value):
+    """ return (dr number without leading zeros, 2 digit year or None) for a Cost Control No, or None """
+
+    if value is None:
+        return None
+
+    m = cost_control_re.match(str(value))
+    if not m:
+        return None
+
+    return m.group(2), m.group(5)
+
+
+def partition_avis_rows(config, sheet_name, avis_all):
+    """ bucket the rows of an avis sheet by configured DR in a single pass.
+
+        Returns { dr_id: [ index into avis_all ] }.  A row goes to every DR configuration that
+        lists its DR number (including extra_drs); a row without a year matches any year.
+        Rows that don't belong to any configured DR are logged.
+    """
 
-    # the DR number format (in the 'Cost Control No' column) isn't well 
     dr_column = 'Cost Control No'
 
-    #for r in avis_all:
-    #    log.debug(f"{ dr_column}: { r[dr_column] }")
+    # dr number -> [ (dr year, dr_id) ]
+    dr_keys = {}
+    for dr_id, dr_config in config.DR_CONFIGURATIONS.items():
+        for dr_num, dr_year in dr_config.get_dr_list():
+            dr_keys.setdefault(dr_num.lstrip('0'), []).append((dr_year, dr_id))
 
-    # trying to match patterns like:
-    # 98, 098, DR098, DR098-21, DR098-2021, 098-21, etc...
-    avis_dr = []
+    rows_by_dr = {}
+    unmatched = {}
+    for index, row in enumerate(avis_all):
+        cost_control = row.get(dr_column)
+        parsed = parse_cost_control(cost_control)
 
-    #log.debug(f"title_row: { title_row }")
+        matched = False
+        if parsed is not None:
+            dr_num, dr_year = parsed
+            dr_ids = set()
+            for config_year, dr_id in dr_keys.get(dr_num, ()):
+                if dr_year is None or dr_year == config_year:
+                    dr_ids.add(dr_id)
 
-    for dr_tuple in dr_config.get_dr_list():
-        dr_num = dr_tuple[0]
-        dr_year = dr_tuple[1]
+            for dr_id in dr_ids:
+                rows_by_dr.setdefault(dr_id, []).append(index)
+                matched = True
 
-        dr_num = dr_num.lstrip('0')
-        dr_regex = re.compile(r"(dr)?\s*0*" f"{ dr_num }" r"(-(20)?" f"{ dr_year })?", flags=re.IGNORECASE)
+        if not matched:
+            unmatched[cost_control] = unmatched.get(cost_control, 0) + 1
 
-        f_result = filter(lambda row: dr_regex.match(row[dr_column]), avis_all)
-        avis_dr.extend( f_result )
+    if len(unmatched) > 0:
+        # the national sheet has thousands of other DRs' values; only list them when debugging
+        log.info(f"{ sheet_name }: { sum(unmatched.values()) } of { len(avis_all) } rows "
+                f"({ len(unmatched) } cost control values) match no configured DR")
+        if log.isEnabledFor(logging.DEBUG):
+            summary = ', '.join(f"'{ k }' ({ v })" for k, v in sorted(unmatched.items(), key=lambda item: str(item[0])))
+            log.debug(f"{ sheet_name }: unmatched cost control values: { summary }")
 
-    log.debug(f"found { len(avis_dr) } vehicles associated with the DR\n\n")
-    
-    return title_row, avis_columns, avis_dr, avis_all
+    return rows_by_dr
 
 
 
 
 def init_o365(config, token_filename, scopes=None):
-    """ do initial setup to get a handle on office 365 graph api """
-
-    log.info(f"init_o365: token_filename %s", token_filename)
-    o365 = arc_o365.arc_o365.arc_o365(config, token_filename, scopes=scopes)
+    """ do initial setup to get a handle on office 365 graph api.
 
-    account = o365.get_account()
-    if account is None:
-        raise Exception("could not access office 365 graph api")
+        Accounts are cached for the whole process (see o365_accounts), so this is cheap to call again
+    """
 
-    return account
+    return o365_accounts.get_account(config, token_filename, scopes=scopes)
 
     
 
-def get_people(config, dr_config, args, session):
+def get_people(config, dr_config, args, session, snap=None):
     """ Retrieve the people list from the DTT (as a json list) """
 
-    data = get_json(config, dr_config, args, session, 'People/Details')
+    data = get_json(config, dr_config, args, session, 'People/Details', snap=snap)
 
     # construct a dict keyed by PersonID
     d = dict( (d['PersonID'], d) for d in data )
     return d
 
 
-def get_vehicles(config, dr_config, args, session):
+def get_vehicles(config, dr_config, args, session, snap=None):
     """ Retrieve the vehicle list from the DTT (as a json list) """
 
-    data = get_json(config, dr_config, args, session, 'Vehicles')
+    data = get_json(config, dr_config, args, session, 'Vehicles', snap=snap)
     log.debug(f"read vehicles: { len(data) } vehicles found")
     #log.debug(f"vehicles { data }")
     return data
 
-def get_agencies(config, dr_config, args, session):
+def get_agencies(config, dr_config, args, session, snap=None):
     """ retrieve the current rental agencies for this DR
 
         return a dict keyed by the AgencyID
     """
 
-    data = get_json(config, dr_config, args, session, 'Agencies', prefix='api/Disasters/')
+    data = get_json(config, dr_config, args, session, 'Agencies', prefix='api/Disasters/', snap=snap)
 
     # construct a dict keyed by AgencyID from the data array
     d = dict( (h['AgencyID'], h) for h in data )
@@ -1624,35 +1658,79 @@ def get_agencies(config, dr_config, args, session):
 
 
 
-def get_json(config, dr_config, args, session, api_type, prefix='api/Disaster/'):
+def fetch_dtt_data(config, dr_config, args, session, snap=None):
+    """ fetch the vehicles, people, and agencies from the DTT at the same time.
+
+        The three api calls are independent, so issue them in parallel and wait for all of them.
+        Returns (vehicles, people, agencies, errors); errors is a dict of endpoint name to exception.
+        Any endpoint that failed has a value of None.
+    """
 
-    file_name = f"cached_{ dr_config.dr_id }_{ re.sub(r'/.*', '', api_type) }.json"
+    fetchers = {
+            'Vehicles': get_vehicles,
+            'People': get_people,
+            'Agencies': get_agencies,
+            }
 
-    data = None
-    if args.cached_input:
-        log.debug(f"reading cached input from { file_name }")
-        with open(file_name, "rb") as f:
-            buffer = f.read()
+    results = {}
+    errors = {}
+    with futures.ThreadPoolExecutor(max_workers=len(fetchers)) as executor:
+        pending = dict( (executor.submit(func, config, dr_config, args, session, snap=snap), name) for name, func in fetchers.items() )
 
-        data = json.loads(buffer)
+        for future in futures.as_completed(pending):
+            name = pending[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                log.error(f"fetch of { name } for dr { dr_config.dr_id } failed: { e }")
+                errors[name] = e
+                results[name] = None
+
+    return results['Vehicles'], results['People'], results['Agencies'], errors
 
-    else:
 
-        url = config.DTT_URL + f"{ prefix }{ dr_config.id }/" + api_type
 
-        r = session.get(url)
-        r.raise_for_status()
+JSON_PARSERS = {
+        'Vehicles': (dtt_ingest.load_vehicles, dtt_ingest.VEHICLES_PARSER_ID),
+        'People/Details': (dtt_ingest.load_people, dtt_ingest.PEOPLE_PARSER_ID),
+        }
+
+def get_json(config, dr_config, args, session, api_type, prefix='api/Disaster/', snap=None):
+    """ fetch one DTT api endpoint.  If snap is a replay snapshot: read the payload from it instead """
+
+    member_name = snapshot.json_member(api_type)
+
+    # the big endpoints are parsed incrementally, keeping only the fields we use
+    parse, parser_id = JSON_PARSERS.get(api_type, (json.load, 'json'))
+
+    if snap is not None and snap.is_replay:
+        log.debug(f"reading { member_name } from snapshot { snap.name }")
+        return parse(io.BytesIO(snap.get(member_name)))
+
+    import web_session
 
-        #log.debug(f"response headers { r.headers }")
-        #log.debug(f"response { r.content }")
+    url = config.DTT_URL + f"{ prefix }{ dr_config.id }/" + api_type
+
+    if not args.no_http_cache:
+        data = http_cache.fetch_json(session, url, config.HTTP_CACHE_DIR, dr_config.dr_id, api_type,
+                timeout=web_session.get_timeout(config), parse=parse, parser_id=parser_id)
+
+        if snap is not None:
+            snap.add(member_name, http_cache.get_body(config.HTTP_CACHE_DIR, dr_config.dr_id, api_type))
+
+        return data
+
+    r = session.get(url, timeout=web_session.get_timeout(config))
+    r.raise_for_status()
 
-        if args.save_input:
-            log.debug(f"saving to { file_name }")
-            with open(file_name, "wb") as f:
-                f.write(r.content)
+    #log.debug(f"response headers { r.headers }")
+    #log.debug(f"response { r.content }")
 
-        data = r.json()
-        #log.debug(f"r.status { r.status_code } r.reason { r.reason } r.url { r.url } r.content_type { r.headers['content-type'] } data rows { len(data) }")
+    if snap is not None:
+        snap.add(member_name, r.content)
+
+    data = parse(io.BytesIO(r.content))
+    #log.debug(f"r.status { r.status_code } r.reason { r.reason } r.url { r.url } r.content_type { r.headers['content-type'] } data rows { len(data) }")
 
     #log.debug(f"json { data }")
     #log.debug(f"Returned data\n{ json.dumps(data, indent=2, sort_keys=True) }")
@@ -1682,11 +1760,13 @@ def store_report(config, account, item_name, wb_bytes):
 def make_group_report(config, dr_config, args, vehicles, people, roster):
     """ make a workbook of all vehicles, arranged by GAPs """
 
+    import openpyxl
+
     wb = openpyxl.Workbook()
     insert_group_overview(wb, dr_config)
 
     # sort the vehicles by GAP
-    vehicles = sorted(vehicles, key=lambda x: vehicle_to_gap(x['Vehicle']))
+    vehicles = sorted(vehicles, key=lambda x: vehicle_to_gap(x.Vehicle))
 
     # add the master sheet
     add_gap_sheet(wb, MASTER, vehicles, people, roster, activity=False)
@@ -1712,12 +1792,10 @@ motor_pool_re = re.compile(r'^Motor Pool \(([^\)]*)\)$')
 def vehicle_to_group(vehicle, activity=False):
     """ turn a Gap (Group/Activity/Position) name into just the Group portion """
 
-    gap = vehicle['GAP']
+    gap = vehicle.GAP
     if gap is None:
         gap = ''
 
-    driver = vehicle['CurrentDriverName']
-
     pool = vehicle_in_pool(vehicle)
     if pool is not None:
         return pool
@@ -1742,7 +1820,7 @@ def vehicle_to_gap(vehicle):
     if pool is not None:
         return pool
 
-    gap = vehicle['GAP']
+    gap = vehicle.GAP
     if gap is None:
         gap = ''
 
@@ -1752,7 +1830,7 @@ def vehicle_to_gap(vehicle):
 
 def vehicle_in_pool(vehicle):
     """ return pool name if vehicle is in a pool, otherwise None """
-    driver = vehicle['CurrentDriverName']
+    driver = vehicle.CurrentDriverName
 
     if driver is None:
         return None
@@ -1768,10 +1846,10 @@ def vehicle_in_pool(vehicle):
 
 
 def get_current_driver(vehicle):
-    person =  vehicle['CurrentDriverName']
+    person =  vehicle.CurrentDriverName
 
     if person is None or person == 'None' or person == '':
-        person = vehicle['RentalAgreementPerson']
+        person = vehicle.RentalAgreementPerson
         log.debug(f"using rental person { person } because current driver is blank")
 
     return person
@@ -1787,12 +1865,12 @@ def get_vehicle_gap_groups(vehicles):
 
     for row in vehicles:
 
-        if row['Status'] != 'Active' and row['Status'] != 'Transferred':
+        if row.Status != 'Active' and row.Status != 'Transferred':
             continue
 
-        vehicle = row['Vehicle']
+        vehicle = row.Vehicle
 
-        gap = vehicle['GAP']
+        gap = vehicle.GAP
         group = vehicle_to_group(vehicle)
 
         if group is None:
@@ -1807,9 +1885,8 @@ def get_vehicle_gap_groups(vehicles):
             #log.debug(f"Adding group { group } from gap { gap }")
             groups[group] = True
 
-        if DISTRICT in vehicle:
-            district = vehicle[DISTRICT]
-            districts[district] = True
+        if vehicle.district is not None:
+            districts[vehicle.district] = True
 
 
     group_list = sorted(groups.keys())
@@ -1823,10 +1900,9 @@ def filter_by_district(district, vehicles):
 
     results = []
     for row in vehicles:
-        veh = row['Vehicle']
+        veh = row.Vehicle
 
-        v_district = veh.get(DISTRICT)
-        if v_district == district:
+        if veh.district == district:
             results.append(row)
 
     return results
@@ -1834,7 +1910,7 @@ def filter_by_district(district, vehicles):
 def filter_by_gap_group(group, vehicles):
     """ only return the vehicles whos GAP starts with the group """
 
-    return list(filter(lambda x: vehicle_to_group(x['Vehicle']) == group, vehicles))
+    return list(filter(lambda x: vehicle_to_group(x.Vehicle) == group, vehicles))
 
 def get_people_column(people, pid, column):
     # look up a person by id (from the vehicle row) and return the specified column
@@ -1853,6 +1929,10 @@ def get_people_column(people, pid, column):
 def add_gap_sheet(wb, sheet_name, vehicles, people, roster, activity=False):
     """ make a new sheet with the specified vehicles """
 
+    import openpyxl.utils
+    import openpyxl.worksheet.table
+    import veh_stats
+
     #log.debug(f"processing sheet '{ sheet_name }' activity { activity }")
     if sheet_name == '':
         sheet_name = "BLANK"
@@ -1864,19 +1944,19 @@ def add_gap_sheet(wb, sheet_name, vehicles, people, roster, activity=False):
     column_defs = {
             'GAP':          { 'width': 15, 'key': lambda x: vehicle_to_gap(x), },
             'Driver':       { 'width': 30, 'key': lambda x: get_current_driver(x), },
-            'Key Number':   { 'width': 12, 'key': lambda x: x['KeyNumber'], },
-            'Vendor':       { 'width': 20, 'key': lambda x: x['Vendor'], },
-            'Cat':          { 'width':  4, 'key': lambda x: x['VehicleCategoryCode'], },
-            'Car Info':     { 'width': 25, 'key': lambda x: f"{ x['Make'] } { x['Model'] } { x['Color'] }", },
-            'Plate':        { 'width': 15, 'key': lambda x: f"{ x['PlateState'] } { x['Plate'] }", },
-            'Type':         { 'width': 10, 'key': lambda x: x['VehicleType'], },
-            'District':     { 'width': 10, 'key': lambda x: x['District'], },
-            'Location':     { 'width': 30, 'key': lambda x: x['CurrentDriverWorkLocationName'], },
-            'Lodging':      { 'width': 30, 'key': lambda x: x['CurrentDriverLodging'], },
-            'Reservation':  { 'width': 15, 'key': lambda x: x['RentalAgreementReservationNumber'], },
-            'Outprocessed': { 'width': 15, 'key': lambda x: "" if not x['OutProcessed'] else "OUTPROCESSED", },
-            'Cell Phone':   { 'width': 13, 'key': lambda x: get_people_column(people, x['CurrentDriverPersonId'], 'MobilePhone'), },
-            'Email':        { 'width': 20, 'key': lambda x: get_people_column(people, x['CurrentDriverPersonId'], 'Email'), },
+            'Key Number':   { 'width': 12, 'key': lambda x: x.KeyNumber, },
+            'Vendor':       { 'width': 20, 'key': lambda x: x.Vendor, },
+            'Cat':          { 'width':  4, 'key': lambda x: x.VehicleCategoryCode, },
+            'Car Info':     { 'width': 25, 'key': lambda x: f"{ x.Make } { x.Model } { x.Color }", },
+            'Plate':        { 'width': 15, 'key': lambda x: f"{ x.PlateState } { x.Plate }", },
+            'Type':         { 'width': 10, 'key': lambda x: x.VehicleType, },
+            'District':     { 'width': 10, 'key': lambda x: x.District, },
+            'Location':     { 'width': 30, 'key': lambda x: x.CurrentDriverWorkLocationName, },
+            'Lodging':      { 'width': 30, 'key': lambda x: x.CurrentDriverLodging, },
+            'Reservation':  { 'width': 15, 'key': lambda x: x.RentalAgreementReservationNumber, },
+            'Outprocessed': { 'width': 15, 'key': lambda x: "" if not x.OutProcessed else "OUTPROCESSED", },
+            'Cell Phone':   { 'width': 13, 'key': lambda x: get_people_column(people, x.CurrentDriverPersonId, 'MobilePhone'), },
+            'Email':        { 'width': 20, 'key': lambda x: get_people_column(people, x.CurrentDriverPersonId, 'Email'), },
         }
 
     row = 1
@@ -1902,14 +1982,14 @@ def add_gap_sheet(wb, sheet_name, vehicles, people, roster, activity=False):
     for vehicle in vehicles:
 
         # only process active vehicles
-        if vehicle['Status'] != 'Active' and vehicle['Status'] != 'Transferred':
-            #log.debug(f"ignorning inactive vehicle, status { vehicle['Status'] }")
+        if vehicle.Status != 'Active' and vehicle.Status != 'Transferred':
+            #log.debug(f"ignorning inactive vehicle, status { vehicle.Status }")
             continue
 
         row += 1
         col = 0
 
-        row_vehicle = vehicle['Vehicle']
+        row_vehicle = vehicle.Vehicle
         group = vehicle_to_group(row_vehicle, activity=activity)
         if group not in seen_groups:
             #log.debug(f"seen new group: '{ group }'")
@@ -1961,7 +2041,7 @@ def add_gap_sheet(wb, sheet_name, vehicles, people, roster, activity=False):
     total_vehicles = 0
     stat_results = []
     for g in seen_groups.keys():
-        roster_count, vehicle_count, category_breakdown = veh_stats.compute_stats(vehicles, roster, g)
+        roster_count, vehicle_count, category_breakdown = veh_stats.compute_stats(vehicles, roster, g, vehicle_to_gap)
         total_vehicles += vehicle_count
         stat_results.append({ 'group': g, 'roster': roster_count, 'vehicle': vehicle_count, 'category_breakdown': category_breakdown })
 
@@ -2030,16 +2110,16 @@ def preprocess_people_roster(dr_config, vehicles, people, roster_by_vc):
     for row in vehicles:
 
         # ignore non-active vehicles
-        if row['Status'] != 'Active':
+        if row.Status != 'Active':
             continue
 
         #log.debug(f"row: { row }")
 
-        vehicle = row['Vehicle']
+        vehicle = row.Vehicle
 
-        driver_id = vehicle['CurrentDriverPersonId']
-        driver = vehicle['CurrentDriverName']
-        veh_code = vehicle['VehicleCategoryCode']
+        driver_id = vehicle.CurrentDriverPersonId
+        driver = vehicle.CurrentDriverName
+        veh_code = vehicle.VehicleCategoryCode
 
         if driver_id is None:
             # no driver assigned yet
@@ -2057,33 +2137,30 @@ def preprocess_people_roster(dr_config, vehicles, people, roster_by_vc):
 
         if driver_id not in people:
             # assumption is we should always be able to find a driver
-            log.error(f"Could not find driver_id { driver_id } in person list ({ vehicle['CurrentDriverNameAndMemberNo'] })")
+            log.error(f"Could not find driver_id { driver_id } in person list ({ vehicle.CurrentDriverNameAndMemberNo })")
             continue
 
         person = people[driver_id]
-        vehicle[PERSON_REF] = person
+        vehicle.person = person
 
         # mark this person as having a vehicle
-        if PERSON_VEHICLES not in person:
-            person[PERSON_VEHICLES] = []
-        person[PERSON_VEHICLES].append(row)
+        if person.vehicles is None:
+            person.vehicles = []
+        person.vehicles.append(row)
 
         #log.debug(f"marking person { driver_id } / { driver } as having a vehicle")
 
-        if ROSTER_REF not in person:
-            vc = person['VC']
-            roster_ref = roster_by_vc.get(vc)
-            person[ROSTER_REF] = roster_ref
-            vehicle[ROSTER_REF] = roster_ref
-        else:
-            roster_ref = person[ROSTER_REF]
-            vehicle[ROSTER_REF] = roster_ref
+        if person.roster is None:
+            person.roster = roster_by_vc.get(person.get('VC'))
+
+        roster_ref = person.roster
+        vehicle.roster = roster_ref
 
         if roster_ref is not None:
-            vehicle[DISTRICT] = roster_ref['District']
-            vehicle[TnM] = roster_ref['T&M']
+            vehicle.district = roster_ref.get('District')
+            vehicle.tnm = roster_ref.get('T&M')
         else:
-            vehicle[TnM] = ''
+            vehicle.tnm = ''
 
 
 vehicle_code_map = {
@@ -2102,7 +2179,7 @@ def vehicle_category_code_to_string(code):
 
 
 def do_status_messages(dr_config, args, account, vehicles, people, roster_by_vc):
-
+    from neil_tools import gen_templates
 
     key_name = 'Mem#'
 
@@ -2121,10 +2198,10 @@ def do_status_messages(dr_config, args, account, vehicles, people, roster_by_vc)
         count = 0
         for person in people.values():
 
-            if PERSON_VEHICLES not in person:
+            if person.vehicles is None:
                 continue
 
-            l = person[PERSON_VEHICLES]
+            l = person.vehicles
 
             first_name = person['FirstName']
             last_name = person['LastName']
@@ -2181,7 +2258,7 @@ def do_status_messages(dr_config, args, account, vehicles, people, roster_by_vc)
             vc_id = person['VC']
 
             # ignore people that have vehicles
-            if PERSON_VEHICLES in person:
+            if person.vehicles is not None:
                 #log.debug(f"ignoring person { first_name } { last_name }: has a vehicle")
                 continue
 
@@ -2323,14 +2400,14 @@ def make_dtr(args, account, dr_config, vehicles):
 
     # compute category sub-totals
     for row in vehicles:
-        veh = row['Vehicle']
-
-        status = row['Status']
-        category = veh['VehicleCategoryCode']
-        type = veh['VehicleType']
-        dvid = row['DisasterVehicleID']
-        vid = veh['VehicleID']
-        gap = veh['GAP']
+        veh = row.Vehicle
+
+        status = row.Status
+        category = veh.VehicleCategoryCode
+        type = veh.VehicleType
+        dvid = row.DisasterVehicleID
+        vid = veh.VehicleID
+        gap = veh.GAP
         group = gap_to_group(gap)
         psc = group_to_psc[group]
         #log.debug(f"gap '{ gap }' group '{ group }'")
@@ -2527,6 +2604,11 @@ def parse_args():
     parser.add_argument("--save", help="Keep a copy of the generated report", action="store_true")
     parser.add_argument("--test-send", help="Add the test email account to message recipients", action="store_true")
     parser.add_argument("--mail-limit", help="max number of emails to send (default: 5)", nargs="?", const=5, type=int)
+    parser.add_argument("--force", help="Regenerate reports even if their inputs haven't changed since the last run", action="store_true")
+    parser.add_argument("--no-http-cache", help="Always download full DTT responses instead of using conditional requests", action="store_true")
+    parser.add_argument("--jobs", help="number of DRs to process in parallel (default: 1)", default=1, type=int)
+    parser.add_argument("--avis-results", help="Also save the avis matching results in this format", choices=['json', 'csv'])
+    parser.add_argument("--avis-results-only", help="Only save the avis matching results (as json unless --avis-results says otherwise); don't build the workbook", action="store_true")
 
     parser.add_argument("--dr-id", help="the name of the DR (like 155-22)", action="append")
     parser.add_argument("--send-to", help="list of recipients (DTR only right now)", action="append")
@@ -2534,8 +2616,9 @@ def parse_args():
     parser.add_argument("--extra-group", help="Extra group/vehicle recipients", action="append")
 
     group = parser.add_mutually_exclusive_group(required=False)
-    group.add_argument("--save-input", help="Save a copy of server inputs", action="store_true")
-    group.add_argument("--cached-input", help="Use cached server input", action="store_true")
+    group.add_argument("--save-input", help="Save a snapshot of all server inputs", action="store_true")
+    group.add_argument("--cached-input", help="Rerun using the latest saved snapshot for each DR", action="store_true")
+    group.add_argument("--replay", help="Rerun offline from a saved snapshot (path, file name, or content hash)", metavar="SNAPSHOT")
 
     args = parser.parse_args()
 
@@ -2559,12 +2642,21 @@ def parse_args():
 
         
 
+    if args.avis_results_only:
+        if args.store or args.send or args.test_send:
+            # there is no avis workbook to store or send
+            log.error("Cannot specify --avis-results-only with --store, --send or --test-send")
+            sys.exit(1)
+
+        if not args.avis_results:
+            args.avis_results = 'json'
+
     if args.do_avis or \
             args.do_group or \
             args.do_car or \
             args.do_no_car or \
             args.do_dtr:
-        if not args.dr_id:
+        if not args.dr_id and not args.replay:
             log.error("Must specify a --dr-id for do_avis, do_group, do_car, do_no_car, do_dtr options")
             sys.exit(1)
 
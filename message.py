@@ -9,20 +9,16 @@ import datetime
 import json
 import io
 import zipfile
-import base64
-
-import requests
-import xlrd
 
 import neil_tools
-import neil_tools.spreadsheet_tools as spreadsheet_tools
 
 import config as config_static
+import o365_accounts
+import attachment_cache
+import file_store
 
-import arc_o365
-#from O365_local.excel import WorkBook as o365_WorkBook
-import O365
-from O365.excel import WorkBook as o365_WorkBook
+# O365 (through o365_accounts/arc_o365) and xlrd are imported by the functions that use them, so
+# importing this module doesn't load them.
 
 
 
@@ -35,6 +31,9 @@ EMAILSTAMP = NOW.strftime("%Y-%m-%d %H-%M")
 # flag field in vehicle structures
 IN_AVIS = '__IN_AVIS__'
 
+# cached attachments not used in this many days are deleted
+ATTACHMENT_CACHE_DAYS = 14
+
 def main():
     args = parse_args()
     if args.debug:
@@ -69,7 +68,8 @@ def fetch_dr_roster(config, dr_id, dr_config):
         message_contains_string = f"DR { dr_id } Automated Workforce Reports"
     attach_match_re = re.compile('^Staff Roster( -)?( Cumulative)?_.*')
 
-    contents, sent_dt = search_mail(account, config.PROGRAM_EMAIL, message_contains_string, attach_match_re)
+    contents, sent_dt = search_mail(account, config.PROGRAM_EMAIL, message_contains_string, attach_match_re,
+            cache_dir=config.ATTACHMENT_CACHE_DIR)
     return contents
 
 #
@@ -79,7 +79,8 @@ def fetch_avis_open_closed(config, account):
 
     message_contains_string = "ARC_Open_and_Closed_Rental_Rpt was executed at"
     attach_match_re = re.compile(r'^ARC_Open_and_Closed_Rental_Rpt.xlsx$')
-    contents, sent_dt = search_mail(account, config.PROGRAM_EMAIL, message_contains_string, attach_match_re)
+    contents, sent_dt = search_mail(account, config.PROGRAM_EMAIL, message_contains_string, attach_match_re,
+            cache_dir=config.ATTACHMENT_CACHE_DIR)
     #log.debug(f"sent_dt was '{ sent_dt }'")
     return contents, sent_dt
 
@@ -87,6 +88,9 @@ def fetch_avis_open_closed(config, account):
 
 def convert_roster_to_objects(contents):
 
+    import xlrd
+    from neil_tools import spreadsheet_tools
+
     # log.debug(f"about to open workbook.  contents { contents[0:8] }")
 
     wb = xlrd.open_workbook(file_contents=contents)
@@ -109,52 +113,104 @@ def convert_roster_to_objects(contents):
     return objects
 
 
-def search_mail(account, mailbox_email, message_match_string, attach_match_re):
+def search_mail(account, mailbox_email, message_match_string, attach_match_re, cache_dir=None):
+    """ find the newest message whose subject contains message_match_string, and return the contents
+        (and sent time) of its first attachment whose name matches attach_match_re.
+
+        Only the attachment metadata is listed; just the matching attachment is downloaded.
+        If cache_dir is set, attachments are cached there by message id: when the newest message
+        hasn't changed since the last run nothing is downloaded.
+    """
+
+    message = find_newest_message(account, mailbox_email, message_match_string)
+    if message is None:
+        return None, None
+
+    pattern = attach_match_re.pattern
+    if cache_dir is not None:
+        content = attachment_cache.lookup(cache_dir, message.object_id, pattern)
+        if content is not None:
+            return content, message.sent
+
+    attachment = find_attachment(message, attach_match_re)
+    if attachment is None:
+        return None, None
+
+    def write_func(fd):
+        download_attachment(message, attachment['id'], fd)
+
+    if cache_dir is not None:
+        content = attachment_cache.store(cache_dir, message.object_id, pattern, attachment, write_func)
+        file_store.prune(cache_dir, ATTACHMENT_CACHE_DAYS)
+    else:
+        stream = io.BytesIO()
+        write_func(stream)
+        content = stream.getvalue()
+
+    log.debug(f"found a match: { attachment['name'] } size { attachment['size'] } len { len(content) }")
+    return content, message.sent
+
+
+def find_newest_message(account, mailbox_email, message_match_string):
+    """ return the most recent message whose subject contains message_match_string, or None """
+
     mailbox = account.mailbox(resource=mailbox_email)
 
     builder = mailbox.new_query()
     dt = datetime.datetime(1900, 1, 1)
-    contents = builder.chain_and(
+    query = builder.chain_and(
             builder.greater('sentDateTime', dt),
             builder.contains('subject', message_match_string))
 
-    
     #messages = mailbox.get_messages(query=contents, order_by=order, limit=1, download_attachments=False)
-    messages = mailbox.get_messages(query=contents, order_by="sentDateTime desc", limit=1, download_attachments=False)
-
+    messages = mailbox.get_messages(query=query, order_by="sentDateTime desc", limit=1, download_attachments=False)
 
     message = next(messages, None)
     if message is None:
-        log.error(f"Failed to read any messages that match { q }")
-        return None, None
+        log.error(f"Failed to read any messages that match '{ message_match_string }'")
+        return None
 
     #log.debug(f"message { message } sent { message.sent }")
+    return message
+
+
+def find_attachment(message, attach_match_re):
+    """ list the attachments of a message (metadata only) and return the first whose name matches """
 
-    message.attachments.download_attachments()
-    attachments = message.attachments
+    url = message.build_url(f"/messages/{ message.object_id }/attachments")
+    response = message.con.get(url, params={ '$select': 'id,name,size,contentType' })
+    if not response:
+        log.error(f"could not list attachments of message { message.object_id }")
+        return None
+
+    attachments = response.json().get('value', [])
     #log.debug(f"attachments len: { len(attachments) }")
 
     for attachment in attachments:
-        #log.debug(f"attachment { attachment } size { attachment.size }")
-        if attach_match_re.search(attachment.name) != None:
-            content = base64.b64decode(attachment.content)
-            log.debug(f"found a match: { attachment.name } size { attachment.size } len { len(content) }")
-            return content, message.sent
+        #log.debug(f"attachment { attachment['name'] } size { attachment['size'] }")
+        if attach_match_re.search(attachment['name']) != None:
+            return attachment
 
-    return None, None
+    return None
 
 
+def download_attachment(message, attachment_id, fd, chunk_size=64 * 1024):
+    """ stream the raw bytes of one attachment into binary file fd (no base64 round trip) """
 
-def init_o365(config, token_filename):
-    """ do initial setup to get a handle on office 365 graph api """
+    url = message.build_url(f"/messages/{ message.object_id }/attachments/{ attachment_id }/$value")
+    response = message.con.get(url, stream=True)
+    if not response:
+        raise Exception(f"could not download attachment { attachment_id } of message { message.object_id }")
 
-    o365 = arc_o365.arc_o365.arc_o365(config, token_filename=token_filename, timezone="America/Los_Angeles")
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        fd.write(chunk)
 
-    account = o365.get_account()
-    if account is None:
-        raise Exception("could not access office 365 graph api")
 
-    return account
+
+def init_o365(config, token_filename):
+    """ do initial setup to get a handle on office 365 graph api (cached for the whole process) """
+
+    return o365_accounts.get_account(config, token_filename, timezone="America/Los_Angeles")
 
 
 
@@ -0,0 +1,64 @@
+
+# process-wide cache of office 365 graph accounts.
+#
+# Setting up an account reads the token file and may refresh the oauth token.  Several parts of a
+# run (avis fetch, roster fetch, per-DR mail) use the same token file, so keep one Account per
+# token file/scope set/timezone and hand it out to everyone.  Token refreshes are serialized so
+# threads sharing an account don't refresh (and rewrite the token file) at the same time.
+
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+_accounts = {}
+_accounts_lock = threading.Lock()
+
+
+def _serialize_refresh(account):
+    """ wrap the account's token refresh in a lock """
+
+    connection = getattr(account, 'con', None)
+    if connection is None or not hasattr(connection, 'refresh_token'):
+        return
+
+    refresh_lock = threading.Lock()
+    refresh_token = connection.refresh_token
+
+    def locked_refresh_token(*args, **kwargs):
+        with refresh_lock:
+            return refresh_token(*args, **kwargs)
+
+    connection.refresh_token = locked_refresh_token
+
+
+def get_account(config, token_filename, scopes=None, timezone=None):
+    """ return the (possibly cached) graph account for a token file """
+
+    key = (token_filename, tuple(sorted(scopes)) if scopes is not None else None, timezone)
+
+    with _accounts_lock:
+        account = _accounts.get(key)
+        if account is not None:
+            return account
+
+        import arc_o365
+
+        log.info(f"init_o365: token_filename { token_filename }")
+
+        kwargs = {}
+        if scopes is not None:
+            kwargs['scopes'] = scopes
+        if timezone is not None:
+            kwargs['timezone'] = timezone
+
+        o365 = arc_o365.arc_o365.arc_o365(config, token_filename=token_filename, **kwargs)
+
+        account = o365.get_account()
+        if account is None:
+            raise Exception("could not access office 365 graph api")
+
+        _serialize_refresh(account)
+        _accounts[key] = account
+
+    return account
@@ -0,0 +1,629 @@
+
+# reconciliation of the Avis open rentals report against the DTT vehicles.
+#
+# This is the matching half of the avis report: it decides, for each Avis row, which DTT vehicles
+# its agreement/reservation/key/plate point at and whether the pickup location, dates and
+# make/model/color agree.  It doesn't know about workbooks; main.render_avis_matches turns the
+# results into cell colors and comments, and write_results dumps them as json or csv.
+
+import os
+import re
+import csv
+import json
+import hashlib
+import collections
+import datetime
+import logging
+
+import fuzzy_match
+from agency_index import AgencyIndex
+
+log = logging.getLogger(__name__)
+
+
+# flag field in avis object array
+AVIS_SOURCE = '__AVIS_SOURCE__'
+AVIS_SOURCE_OPEN       = 'OPEN'
+AVIS_SOURCE_OPEN_ALL   = 'OPEN_ALL'
+AVIS_SOURCE_CLOSED     = 'CLOSED'
+AVIS_SOURCE_CLOSED_ALL = 'CLOSED_ALL'
+AVIS_SOURCE_MISSING    = 'MISSING'
+
+# how an avis row matched the DTT
+MATCH_SYNTHETIC = 'synthetic'   # row made up from a DTT vehicle (see main.make_avis_from_vehicle); not checked
+MATCH_NONE      = 'none'        # no identifier found in the DTT
+MATCH_ALL       = 'all'         # all four identifiers found, on the same DTT vehicle
+MATCH_PARTIAL   = 'partial'     # some identifiers missing, or found on different vehicles
+
+# the avis identifier columns, and the VehicleIndex index each is looked up in
+ID_COLUMNS = (
+        ('ra',      'Rental Agreement No'),
+        ('res',     'Reservation No'),
+        ('key',     'MVA No'),
+        ('plate',   'License Plate Number'),
+        )
+
+# avis date columns, their time columns, and the DTT field (and its parsed records.VehicleDetails
+# attribute) to compare them to
+DATE_COLUMNS = (
+        ('CO Date',     'CO Time',      'RentalAgreementPickupDate',    'pickup_dt'),
+        ('Exp CI Date', 'Exp CI Time',  'DueDate',                      'due_dt'),
+        )
+
+# avis make/model/color columns
+MAKE_COLUMNS = ('Make', 'Model', 'Ext Color Code')
+
+
+def cleanup_v_field(vehicle, field_name):
+    """ do field cleanup for vehicle entries """
+
+    if field_name not in vehicle:
+        return None
+
+    value = vehicle[field_name]
+
+    if value is None:
+        return None
+
+    value = value.strip()
+
+    if field_name == 'RentalAgreementNumber':
+        # rental agreements always start with 'U'; add it if not present
+        if value[0] != 'U':
+            value = 'U' + value
+
+    elif field_name == 'RentalAgreementReservationNumber':
+        # the emailed reservation number looks like 12345678-US-6; put it in cannonical form
+        value = value.replace('-', '').upper()
+
+    elif field_name == 'KeyNumber':
+        # make sure there are 9 digits in the number
+        value = value.rjust(9, '0')
+
+
+    return value
+
+
+def add_to_vehicle_index(result, key, row):
+    """ add a vehicle to an index.  If two vehicles share a key, prefer the active one """
+
+    if key in result:
+        old_row = result[key]
+
+        if old_row.Status == 'Active' and row.Status == 'Active':
+            log.error(f"Error: Duplicate rows with key '{ key }' and both are active")
+            log.info(f"DUPLICATE: key '{ key }' is already in result.\n\nExisting{ result[key] }\n\nnew { row }")
+
+        else:
+            # at most one row is active
+            #log.info(f"Error: Duplicate rows with key '{ key }', at most one active "
+            #        f"(old: '{ old_row['Vehicle']['KeyNumber'] }', "
+            #        f"new '{ row['Vehicle']['KeyNumber'] }')"
+            #        )
+
+            if row.Status == 'Active':
+                # we know that old_row is not active, so use the current row.
+                result[key] = row
+    else:
+        # first row with this key
+        result[key] = row
+
+
+class VehicleIndex:
+    """ lookup tables over a DR's DTT vehicles, keyed by the identifiers the Avis report has.
+
+        Built once per DR (in a single pass over the vehicles) and shared by the avis report
+        stages.  The index also records which vehicles were found in the Avis report.
+    """
+
+    # index name -> DTT field(s) that make up the key
+    KEY_FIELDS = {
+            'ra':       ('RentalAgreementNumber',),
+            'res':      ('RentalAgreementReservationNumber',),
+            'key':      ('KeyNumber',),
+            'plate':    ('PlateState', 'Plate'),
+            }
+
+    def __init__(self, vehicles):
+        self._by_id = {}
+        self._indexes = dict( (name, {}) for name in self.KEY_FIELDS )
+        self._in_avis = set()
+        self._fuzzy = {}
+
+        for row in vehicles:
+            vid = row.DisasterVehicleID
+            if vid in self._by_id:
+                log.error(f"Duplicate key { vid } in vehicles: old { self._by_id[vid] } new { row }")
+            else:
+                self._by_id[vid] = row
+
+            vehicle = row.Vehicle
+            for name, fields in self.KEY_FIELDS.items():
+                key = self.vehicle_key(vehicle, fields)
+                if key is not None:
+                    add_to_vehicle_index(self._indexes[name], key, row)
+
+    @staticmethod
+    def vehicle_key(vehicle, fields):
+        """ the normalized key for a vehicle from one or two fields, or None if a field is missing """
+
+        first_field = fields[0]
+        if first_field not in vehicle:
+            return None
+
+        key = cleanup_v_field(vehicle, first_field)
+        if key is None:
+            return None
+
+        if len(fields) > 1:
+            second = vehicle.get(fields[1])
+            if second is None:
+                return None
+            key = key + " " + second.strip()
+
+        return key.upper()
+
+    @property
+    def by_id(self):
+        """ DisasterVehicleID -> vehicle row """
+        return self._by_id
+
+    def get(self, vid):
+        return self._by_id[vid]
+
+    def find(self, index_name, value):
+        """ return the DisasterVehicleID of the vehicle whose index_name key is value (or None).
+
+            A vehicle that is found is marked as being in the Avis report.
+        """
+
+        row = self._indexes[index_name].get(value.upper())
+        if row is None:
+            return None
+
+        vid = row.DisasterVehicleID
+        self._in_avis.add(vid)
+        return vid
+
+    @staticmethod
+    def avis_row_keys(row):
+        """ the values of an avis row to look up in each index """
+
+        return {
+                'ra':       row['Rental Agreement No'],
+                'res':      row['Reservation No'],
+                'key':      row['MVA No'],
+                'plate':    row['License Plate State Code'] + ' ' + row['License Plate Number'],
+                }
+
+    def find_avis_row(self, row):
+        """ look up an avis row by agreement, reservation, key and plate.  Returns the four DisasterVehicleIDs """
+
+        keys = self.avis_row_keys(row)
+        return (self.find('ra', keys['ra']),
+                self.find('res', keys['res']),
+                self.find('key', keys['key']),
+                self.find('plate', keys['plate']))
+
+    def suggest(self, index_name, value, preferred_ids=()):
+        """ find the DTT vehicle most likely meant by a value that isn't in the index (a typo on one side).
+
+            Candidates are the keys within a small edit distance of value.  Vehicles in
+            preferred_ids (the ones the row's other identifiers matched) win over closer keys.
+            Returns { vehicle_id, value, distance } or None.  Doesn't mark anything as in the Avis report.
+        """
+
+        if value is None:
+            return None
+        value = value.strip().upper()
+        if value == '':
+            return None
+
+        index = self._fuzzy.get(index_name)
+        if index is None:
+            # only built for indexes that have misses
+            index = fuzzy_match.DeletionIndex(self._indexes[index_name].keys(), max_distance=2)
+            self._fuzzy[index_name] = index
+
+        max_distance = 1 if len(value) <= 5 else 2
+        best = None
+        for distance, key in index.search(value, max_distance):
+            vid = self._indexes[index_name][key].DisasterVehicleID
+            rank = (vid not in preferred_ids, distance, key)
+            if best is None or rank < best[0]:
+                best = (rank, { 'vehicle_id': vid, 'value': key, 'distance': distance })
+
+        return best[1] if best is not None else None
+
+    def in_avis(self, row):
+        """ True if the vehicle was found by an avis lookup """
+        return row.DisasterVehicleID in self._in_avis
+
+
+class AvisRowIndex:
+    """ lookup tables over the (national) avis rows, keyed by agreement, reservation, key and plate.
+
+        Built once per avis report, in a single pass over all the sheets, and shared by every DR.
+        Entries are (sheet name, position in the sheet's rows).  Agreement and reservation numbers
+        belong to one rental, but a car (key, plate) shows up once per rental: for those an earlier
+        sheet wins over a later one, and within a sheet the rental with the latest CO Date wins.
+    """
+
+    def __init__(self, sheets):
+        """ sheets is [ (sheet name, rows) ], in order of preference """
+
+        self._indexes = dict( (name, {}) for name, column in ID_COLUMNS )
+
+        for rank, (sheet_name, rows) in enumerate(sheets):
+            for position, row in enumerate(rows):
+                co_date = row.get('CO Date')
+                for name, key in self.row_keys(row).items():
+                    if key is None:
+                        continue
+
+                    index = self._indexes[name]
+                    old = index.get(key)
+                    if old is None or (old[0] == rank and old[3] is not None and co_date is not None and co_date > old[3]):
+                        index[key] = (rank, sheet_name, position, co_date)
+
+    @staticmethod
+    def row_keys(row):
+        """ the normalized identifiers of an avis row (None for a blank one) """
+
+        keys = {}
+        for name, column in ID_COLUMNS:
+            value = row.get(column)
+            value = str(value).strip().upper() if value is not None else ''
+            keys[name] = value if value != '' else None
+
+        state = row.get('License Plate State Code')
+        if keys['plate'] is not None:
+            keys['plate'] = f"{ str(state).strip().upper() } { keys['plate'] }" if state else None
+
+        return keys
+
+    def find_vehicle(self, vehicle):
+        """ the avis rows any of a DTT vehicle's identifiers appear in.
+
+            Returns [ (sheet name, position) ], rows from the most preferred sheet first.
+        """
+
+        found = set()
+        for name, fields in VehicleIndex.KEY_FIELDS.items():
+            key = VehicleIndex.vehicle_key(vehicle, fields)
+            if key is not None:
+                entry = self._indexes[name].get(key)
+                if entry is not None:
+                    found.add(entry[:3])
+
+        return [ (sheet_name, position) for rank, sheet_name, position in sorted(found) ]
+
+
+# DTT make/model/color -> avis code tables.  Edit the json file to add a mapping.
+TRANSLATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'avis_translations.json')
+
+# translation kind for each of MAKE_COLUMNS
+MAKE_KINDS = ('make', 'model', 'color')
+
+
+class MakeTranslations:
+    """ compiled DTT make/model/color -> avis code tables
+
+        Each DTT value maps to the frozenset of avis codes it may appear as, and each avis code maps
+        back to the DTT values it stands for.  translate() is memoized per distinct (make, model, color).
+    """
+
+    def __init__(self, tables, unreported=(), digest=None):
+        self.digest = digest    # hash of the source file, for report fingerprints
+        self._forward = {}      # kind -> { DTT value: frozenset(avis codes) }
+        self._reverse = {}      # kind -> { avis code: frozenset(DTT values) }
+
+        for kind in MAKE_KINDS:
+            forward = {}
+            reverse = {}
+            for value, codes in tables.get(kind, {}).items():
+                codes = frozenset([ codes ] if isinstance(codes, str) else codes)
+                forward[value] = codes
+                for code in codes:
+                    reverse.setdefault(code, set()).add(value)
+
+            self._forward[kind] = forward
+            self._reverse[kind] = dict( (code, frozenset(values)) for code, values in reverse.items() )
+
+        # (kind, DTT value) pairs with no avis code that aren't worth reporting
+        self._unreported = frozenset(unreported)
+        self._memo = {}
+
+    @classmethod
+    def load(cls, file_name=TRANSLATIONS_FILE):
+        with open(file_name, "rb") as f:
+            contents = f.read()
+
+        data = json.loads(contents)
+        return cls(data, unreported=( ('color', color) for color in data.get('unreported_colors', ()) ),
+                digest=hashlib.sha256(contents).hexdigest())
+
+    def translate(self, triple):
+        """ return (codes, unmapped) for a DTT (make, model, color).
+
+            codes has the accepted avis codes for each of the three (None if the value isn't in the
+            tables); unmapped lists the (kind, DTT value) pairs that should be reported as missing.
+        """
+
+        result = self._memo.get(triple)
+        if result is None:
+            codes = tuple( self._forward[kind].get(value) for kind, value in zip(MAKE_KINDS, triple) )
+            unmapped = tuple( (kind, value) for kind, value, c in zip(MAKE_KINDS, triple, codes)
+                    if c is None and (kind, value) not in self._unreported )
+            result = (codes, unmapped)
+            self._memo[triple] = result
+
+        return result
+
+    def dtt_values(self, kind, code):
+        """ the DTT values that translate to an avis code """
+        return self._reverse[kind].get(code, frozenset())
+
+
+_translations = None
+def get_translations():
+    """ the MakeTranslations from TRANSLATIONS_FILE, loaded on first use """
+
+    global _translations
+    if _translations is None:
+        _translations = MakeTranslations.load()
+    return _translations
+
+
+def log_unmapped(unmapped):
+    """ report the DTT values (with row counts) that had no avis translation """
+
+    for kind in MAKE_KINDS:
+        values = sorted( (str(value), count) for (k, value), count in unmapped.items() if k == kind )
+        if values:
+            log.info(f"no avis translation for DTT { kind }: " + ', '.join(f"'{ value }' ({ count })" for value, count in values))
+
+
+time_regex = re.compile(r'(\d{2}):(\d{2}):(\d{2})')
+def avis_datetime(row, date_key, time_key):
+    """ combine an avis date column and its time column into a datetime (or None) """
+
+    value = row.get(date_key)
+    if value is None:
+        return None
+
+    if isinstance(value, datetime.datetime):
+        return value
+
+    from neil_tools import spreadsheet_tools
+
+    dt = spreadsheet_tools.excel_to_dt(value)
+
+    time_string = row.get(time_key)
+    time_match = time_regex.match(time_string) if isinstance(time_string, str) else None
+    if time_match:
+        interval = datetime.timedelta(hours=int(time_match.group(1)), minutes=int(time_match.group(2)), seconds=int(time_match.group(3)))
+        dt += interval
+    else:
+        log.debug(f"avis_datetime: { time_key } didn't parse: '{ time_string }'")
+
+    return dt
+
+
+def normalize_avis_dates(rows):
+    """ replace each avis date column with a datetime that includes its time column.
+
+        The avis report doesn't say what timezone its times are in (they are local to the rental
+        counter), so the results are naive.
+    """
+
+    for row in rows:
+        for (avis_col, time_col, dtt_col, dtt_attr) in DATE_COLUMNS:
+            if avis_col in row:
+                row[avis_col] = avis_datetime(row, avis_col, time_col)
+
+
+multispace_re = re.compile(r'\s+')
+def reconcile_avis_rows(avis, vehicle_index, agencies, agency_index=None):
+    """ match avis rows against the DTT vehicles.  Returns one result dict per row, in order
+
+        Each result has:
+            match       one of the MATCH_* values
+            source      where the row came from (AVIS_SOURCE_*), or None
+            ids         { 'ra'/'res'/'key'/'plate': DisasterVehicleID or None }
+            vehicle_id  the matching DisasterVehicleID when match is MATCH_ALL
+
+        when match is MATCH_PARTIAL:
+            suggestions { 'ra'/'res'/'key'/'plate': { vehicle_id, value, distance } } for the
+                        identifiers that weren't found but are close to a DTT value
+
+        and when match is MATCH_ALL:
+            agency      { agency_id, match, avis, dtt, resolved } for the pickup location, or None
+                        if the vehicle's agency isn't in the DTT agency list.  resolved lists the
+                        AgencyIDs the avis location was found at (see agency_index.AgencyIndex)
+            dates       [ { column, dtt, avis, match } ] for the dates present in the avis row
+            make        [ { column, dtt, mapped, match, avis_means } ] for make/model/color; mapped
+                        is the sorted list of avis codes the DTT value translates to, or None when
+                        it isn't in the translation tables.  avis_means lists the DTT values the
+                        avis code stands for (only on a mismatch)
+    """
+
+    results = []
+    agency_no_match_list = {}
+    translations = get_translations()
+    unmapped = collections.Counter()
+
+    if agency_index is None:
+        agency_index = AgencyIndex(agencies)
+
+    for row in avis:
+        result = {
+                'match': None,
+                'source': row.get(AVIS_SOURCE),
+                'ids': None,
+                'vehicle_id': None,
+                }
+        results.append(result)
+
+        if row['Cost Control No'] == 'MISSING':
+            # this is a synthetic row created from the DTT, not AVIS; don't bother matching
+            result['match'] = MATCH_SYNTHETIC
+            continue
+
+        # use DisasterVehicleID as the DTT identity for a vehicle
+        ra_id, res_id, key_id, plate_id = vehicle_index.find_avis_row(row)
+        result['ids'] = { 'ra': ra_id, 'res': res_id, 'key': key_id, 'plate': plate_id }
+
+        if ra_id == None and res_id == None and key_id == None and plate_id == None:
+            result['match'] = MATCH_NONE
+            continue
+
+        if not (ra_id == res_id and ra_id == key_id and ra_id == plate_id):
+            result['match'] = MATCH_PARTIAL
+            result['suggestions'] = suggest_missing(row, vehicle_index, result['ids'])
+            continue
+
+        # all four 'unique' fields match: check additional fields
+        result['match'] = MATCH_ALL
+        result['vehicle_id'] = ra_id
+
+        vehicle = vehicle_index.get(ra_id).Vehicle
+        result['agency'] = check_agency(row, vehicle, agencies, agency_index, agency_no_match_list)
+        result['dates'] = check_dates(row, vehicle)
+        result['make'] = check_make(row, vehicle, translations, unmapped)
+
+    log_unmapped(unmapped)
+    return results
+
+
+def suggest_missing(row, vehicle_index, ids):
+    """ for each identifier that wasn't found: the likely DTT vehicle (see VehicleIndex.suggest) """
+
+    found = set( vid for vid in ids.values() if vid is not None )
+    keys = vehicle_index.avis_row_keys(row)
+
+    suggestions = {}
+    for index_name, vid in ids.items():
+        if vid is None:
+            suggestion = vehicle_index.suggest(index_name, keys[index_name], preferred_ids=found)
+            if suggestion is not None:
+                suggestions[index_name] = suggestion
+
+    return suggestions
+
+
+def check_agency(row, vehicle, agencies, agency_index, agency_no_match_list):
+    """ compare the avis pickup location to the DTT agency """
+
+    agency_id = vehicle.PickupAgencyId
+    if agency_id not in agencies:
+        log.debug(f"could not find agency key '{ agency_id }' in v_agencies ")
+        return None
+
+    addr_line = ''
+    if 'Address Line 1' in row and 'Address Line 3' in row:
+        addr_line = f"{ row['Address Line 1'] }/{ row['Address Line 3'] }"
+        addr_line = multispace_re.sub(' ', addr_line)
+
+    resolved = agency_index.resolve(row)
+    match = agency_id in resolved
+
+    agency_string = agencies[agency_id]['AvisAgencyString']
+    if not match and agency_string not in agency_no_match_list:
+        # only print once per agency
+        log.debug(f"no agency match '{ addr_line }' / '{ agency_string }'")
+        agency_no_match_list[agency_string] = True
+
+    return { 'agency_id': agency_id, 'match': match, 'avis': addr_line, 'dtt': agency_string, 'resolved': sorted(resolved) }
+
+
+def check_dates(row, vehicle):
+    """ compare the avis pickup and expected return dates to the DTT.
+
+        Both sides were parsed when they were loaded (normalize_avis_dates, records.VehicleDetails)
+    """
+
+    results = []
+    for (avis_col, time_col, dtt_col, dtt_attr) in DATE_COLUMNS:
+        avis_dt = row.get(avis_col)
+        if avis_dt is None:
+            continue
+
+        dtt_dt = getattr(vehicle, dtt_attr)
+        dtt_date = None
+        if dtt_dt is not None:
+            dtt_date = dtt_dt.date()
+        elif str(vehicle.get(dtt_col) or '').strip() == '':
+            # the date just hasn't been entered in the DTT; common, and not an error
+            log.debug(f"no { dtt_col } date for vehicle key { vehicle.KeyNumber }")
+        else:
+            log.error(f"could not convert '{ vehicle.get(dtt_col) }' from field { dtt_col } to a date for vehicle key { vehicle.KeyNumber }")
+
+        avis_date = avis_dt.date()
+        results.append({ 'column': avis_col, 'dtt': dtt_date, 'avis': avis_date, 'match': dtt_date == avis_date })
+
+    return results
+
+
+def check_make(row, vehicle, translations, unmapped):
+    """ compare the avis make/model/color codes to the (translated) DTT values.
+
+        unmapped counts the (kind, DTT value) pairs with no translation
+    """
+
+    dtt_veh_make = (vehicle.Make.strip() if vehicle.Make != None else None,
+            vehicle.Model.strip() if vehicle.Model != None else None,
+            vehicle.Color.strip() if vehicle.Color != None else None)
+    codes, missing = translations.translate(dtt_veh_make)
+    unmapped.update(missing)
+
+    results = []
+    for (i, col_name) in enumerate(MAKE_COLUMNS):
+        accepted = codes[i]
+        avis_value = row[col_name]
+
+        result = { 'column': col_name, 'dtt': dtt_veh_make[i], 'mapped': None, 'match': False }
+        if accepted is not None:
+            result['mapped'] = sorted(accepted)
+            result['match'] = avis_value in accepted
+            if not result['match']:
+                result['avis_means'] = sorted(translations.dtt_values(MAKE_KINDS[i], avis_value))
+
+        results.append(result)
+
+    return results
+
+
+def write_results(file_name, avis, results, file_format='json'):
+    """ save reconciliation results (with the avis identifiers of each row) as json or csv """
+
+    rows_out = []
+    for row, result in zip(avis, results):
+        record = dict( (col, row.get(col)) for col in ('Cost Control No', 'Rental Agreement No',
+                'Reservation No', 'MVA No', 'License Plate State Code', 'License Plate Number') )
+        record.update(result)
+        rows_out.append(record)
+
+    if file_format == 'csv':
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([ 'Cost Control No', 'Rental Agreement No', 'Reservation No', 'MVA No',
+                    'License Plate State Code', 'License Plate Number', 'match', 'source', 'vehicle_id',
+                    'ra_id', 'res_id', 'key_id', 'plate_id', 'agency_match', 'date_mismatches', 'make_mismatches',
+                    'make_unmapped', 'suggestions' ])
+
+            for r in rows_out:
+                ids = r['ids'] or {}
+                agency = r.get('agency')
+                writer.writerow([ r['Cost Control No'], r['Rental Agreement No'], r['Reservation No'], r['MVA No'],
+                        r['License Plate State Code'], r['License Plate Number'], r['match'], r['source'], r['vehicle_id'],
+                        ids.get('ra'), ids.get('res'), ids.get('key'), ids.get('plate'),
+                        agency['match'] if agency is not None else '',
+                        ' '.join(d['column'] for d in r.get('dates', []) if not d['match']),
+                        # a DTT make with no translation isn't a mismatch; it gets its own column
+                        ' '.join(m['column'] for m in r.get('make', []) if not m['match'] and m['mapped'] is not None),
+                        ' '.join(m['column'] for m in r.get('make', []) if m['mapped'] is None),
+                        ' '.join(f"{ name }:{ sug['value'] }" for name, sug in r.get('suggestions', {}).items()) ])
+    else:
+        with open(file_name, 'w') as f:
+            json.dump(rows_out, f, indent=2, default=str)
@@ -0,0 +1,197 @@
+
+# compact records for the DTT vehicles and people and the staff roster.
+#
+# These used to be the raw json (and spreadsheet row) dicts, and the report stages linked them
+# together by adding marker keys (__PERSON_REF__, __ROSTER_REF__, __DISTRICT__...).  The classes
+# here use __slots__, keep only the fields the reports use, and make the links plain attributes.
+#
+# DTT fields keep their json names (vehicle.KeyNumber).  Records can still be read like the dicts
+# they replaced (record['KeyNumber'], record.get(...), 'KeyNumber' in record) so the mail templates
+# and the less busy code paths work unchanged.  A field that was missing from the source is left
+# unset, so 'Field' in record means the same thing it did for the dict.
+#
+# The DTT timestamps used in comparisons are also parsed once, here, into datetimes.
+
+import re
+import datetime
+
+
+# top level fields of a Vehicles record
+VEHICLE_RECORD_FIELDS = (
+        'DisasterCode',
+        'DisasterVehicleID',
+        'Status',
+        'TransferredToDRCode',
+        )
+
+# fields of the nested 'Vehicle' object
+VEHICLE_FIELDS = (
+        'Color',
+        'CurrentDriverLodging',
+        'CurrentDriverName',
+        'CurrentDriverNameAndMemberNo',
+        'CurrentDriverPersonId',
+        'CurrentDriverWorkLocationName',
+        'District',
+        'DueDate',
+        'GAP',
+        'KeyNumber',
+        'Make',
+        'Model',
+        'OutProcessed',
+        'PickupAgencyId',
+        'PickupAgencyName',
+        'Plate',
+        'PlateState',
+        'RentalAgreementNumber',
+        'RentalAgreementPerson',
+        'RentalAgreementPickupDate',
+        'RentalAgreementReservationNumber',
+        'VehicleCategoryCode',
+        'VehicleID',
+        'VehicleType',
+        'Vendor',
+        )
+
+PERSON_FIELDS = (
+        'Email',
+        'FirstName',
+        'GAP',
+        'LastName',
+        'MobilePhone',
+        'Name',
+        'PersonID',
+        'Status',
+        'VC',
+        'WorkLocation',
+        )
+
+# staff roster column title -> attribute
+ROSTER_COLUMNS = (
+        ('Mem#',            'mem_no'),
+        ('Name',            'name'),
+        ('District',        'district'),
+        ('T&M',             'tnm'),
+        ('GAP(s)',          'gaps'),
+        ('Released',        'released'),
+        ('Location type',   'location_type'),
+        )
+
+
+class Record:
+    """ base class: fields copied from a source dict, readable by their source name """
+
+    __slots__ = ()
+
+    # (source key, attribute name) for each field copied from the source
+    COLUMNS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._ATTRS = dict(cls.COLUMNS)
+
+    def __init__(self, source):
+        for key, attr in self.COLUMNS:
+            if key in source:
+                setattr(self, attr, source[key])
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._ATTRS.get(key, key))
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return hasattr(self, self._ATTRS.get(key, key))
+
+    def get(self, key, default=None):
+        return getattr(self, self._ATTRS.get(key, key), default)
+
+    def __iter__(self):
+        """ the source keys of the fields that are set """
+        return ( key for key, attr in self.COLUMNS if hasattr(self, attr) )
+
+    def to_dict(self):
+        """ the source fields, as a dict keyed by their source names """
+        return dict( (key, getattr(self, attr)) for key, attr in self.COLUMNS if hasattr(self, attr) )
+
+    def __repr__(self):
+        return f"{ type(self).__name__ }({ self.to_dict() })"
+
+
+fraction_re = re.compile(r'(\.\d{6})\d+')
+def parse_dtt_datetime(value):
+    """ parse a DTT timestamp ("2021-06-25T00:00:00-04:00").  Returns None if it is missing or doesn't parse.
+
+        The DTT includes the utc offset, so the result is timezone aware.
+    """
+
+    if not isinstance(value, str):
+        return None
+
+    # the DTT sometimes sends 7 fractional digits; fromisoformat takes at most 6
+    value = fraction_re.sub(r'\1', value.strip())
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _same_names(fields):
+    return tuple( (f, f) for f in fields )
+
+
+class VehicleDetails(Record):
+    """ the nested 'Vehicle' object of a DTT vehicle, plus links set by preprocess_people_roster """
+
+    COLUMNS = _same_names(VEHICLE_FIELDS)
+    __slots__ = VEHICLE_FIELDS + ('pickup_dt', 'due_dt', 'person', 'roster', 'district', 'tnm')
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.pickup_dt = parse_dtt_datetime(source.get('RentalAgreementPickupDate'))
+        self.due_dt = parse_dtt_datetime(source.get('DueDate'))
+
+        self.person = None          # Person driving the vehicle
+        self.roster = None          # the driver's RosterEntry
+        self.district = None        # the driver's district from the roster
+        self.tnm = None             # the driver's T&M from the roster
+
+
+class Vehicle(Record):
+    """ a DTT Vehicles record """
+
+    COLUMNS = _same_names(VEHICLE_RECORD_FIELDS)
+    __slots__ = VEHICLE_RECORD_FIELDS + ('Vehicle',)
+
+    def __init__(self, source):
+        super().__init__(source)
+        vehicle = source.get('Vehicle')
+        self.Vehicle = VehicleDetails(vehicle) if vehicle is not None else None
+
+    def to_dict(self):
+        result = super().to_dict()
+        result['Vehicle'] = self.Vehicle.to_dict() if self.Vehicle is not None else None
+        return result
+
+
+class Person(Record):
+    """ a DTT People/Details record """
+
+    COLUMNS = _same_names(PERSON_FIELDS)
+    __slots__ = PERSON_FIELDS + ('vehicles', 'roster')
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.vehicles = None        # list of Vehicle records this person drives, if any
+        self.roster = None          # RosterEntry for this person
+
+
+class RosterEntry(Record):
+    """ a row of the staff roster spreadsheet """
+
+    COLUMNS = ROSTER_COLUMNS
+    __slots__ = tuple( attr for key, attr in ROSTER_COLUMNS )
@@ -0,0 +1,176 @@
+
+# versioned store of the inputs to a DR run.
+#
+# A snapshot holds everything a run read from the outside world: the DTT json payloads, the Avis
+# attachment, and the staff roster.  Each snapshot is written as one compressed zip file named
+# <dr_id>_<timestamp>_<content hash>.zip, so old snapshots are never overwritten and a run can be
+# replayed offline from any of them (see --replay in main.py).
+
+import os
+import os.path
+import re
+import json
+import glob
+import hashlib
+import zipfile
+import datetime
+import threading
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+META_MEMBER = 'meta.json'
+AVIS_MEMBER = 'avis.xlsx'
+ROSTER_MEMBER = 'roster.xls'
+
+HASH_LENGTH = 12
+
+
+class MissingInput(KeyError):
+    """ a replayed snapshot doesn't have an input the run needs """
+
+
+def json_member(api_type):
+    """ the name of the snapshot member for a DTT endpoint (People/Details -> People.json) """
+    return re.sub(r'/.*', '', api_type) + ".json"
+
+
+class Snapshot:
+
+    def __init__(self, dr_id, members=None, meta=None, path=None):
+        """ a new snapshot is writable; one read back from disk (path is set) is only for replay """
+        self._dr_id = dr_id
+        self._members = members if members is not None else {}
+        self._meta = meta if meta is not None else {}
+        self._path = path
+        self._lock = threading.Lock()
+
+    @property
+    def dr_id(self):
+        return self._dr_id
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def is_replay(self):
+        return self._path is not None
+
+    @property
+    def name(self):
+        if self._path is None:
+            return None
+        return os.path.basename(self._path)
+
+    def add(self, member_name, contents):
+        """ record the raw bytes of an input """
+        with self._lock:
+            self._members[member_name] = bytes(contents)
+
+    def get(self, member_name):
+        """ return the raw bytes of an input; raises MissingInput if the snapshot doesn't have it """
+        if member_name not in self._members:
+            raise MissingInput(f"snapshot { self.name } has no { member_name }")
+        return self._members[member_name]
+
+    def has(self, member_name):
+        return member_name in self._members
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._meta[key] = value
+
+    def get_meta(self, key, default=None):
+        return self._meta.get(key, default)
+
+    def require_meta(self, key):
+        """ return a metadata value; raises MissingInput if the snapshot doesn't have it """
+        if self._meta.get(key) is None:
+            raise MissingInput(f"snapshot { self.name } has no { key } metadata")
+        return self._meta[key]
+
+    def content_hash(self):
+        """ hash of all the inputs (not the metadata), used to name and de-duplicate snapshots """
+        h = hashlib.sha256()
+        for member_name in sorted(self._members.keys()):
+            h.update(member_name.encode())
+            h.update(hashlib.sha256(self._members[member_name]).digest())
+        return h.hexdigest()[:HASH_LENGTH]
+
+    def save(self, snapshot_dir, now=None):
+        """ write the snapshot to snapshot_dir.  Returns the path of the file.
+
+            If the most recent snapshot for this DR has identical contents it is reused instead.
+        """
+
+        if now is None:
+            now = datetime.datetime.now().astimezone()
+
+        content_hash = self.content_hash()
+
+        latest = find_latest(snapshot_dir, self._dr_id)
+        if latest is not None and latest.endswith(f"_{ content_hash }.zip"):
+            log.debug(f"inputs unchanged since { os.path.basename(latest) }; not writing a new snapshot")
+            return latest
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        file_name = os.path.join(snapshot_dir, f"{ self._dr_id }_{ now.strftime('%Y%m%d-%H%M%S') }_{ content_hash }.zip")
+
+        meta = dict(self._meta)
+        meta['dr_id'] = self._dr_id
+        meta['created'] = now.isoformat()
+        meta['content_hash'] = content_hash
+
+        with file_store.atomic_open(file_name) as f:
+            with zipfile.ZipFile(f, mode='w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as z:
+                z.writestr(META_MEMBER, json.dumps(meta, indent=2))
+                for member_name, contents in self._members.items():
+                    z.writestr(member_name, contents)
+        log.info(f"saved snapshot { file_name }")
+        return file_name
+
+
+def load(path):
+    """ read a snapshot back for replay """
+
+    members = {}
+    with zipfile.ZipFile(path, mode='r') as z:
+        meta = json.loads(z.read(META_MEMBER))
+        for member_name in z.namelist():
+            if member_name != META_MEMBER:
+                members[member_name] = z.read(member_name)
+
+    log.debug(f"loaded snapshot { path }: { sorted(members.keys()) }")
+    return Snapshot(meta['dr_id'], members=members, meta=meta, path=path)
+
+
+def find_latest(snapshot_dir, dr_id):
+    """ return the path of the newest snapshot for a DR, or None """
+
+    # the timestamp in the name sorts chronologically
+    paths = sorted(glob.glob(os.path.join(snapshot_dir, f"{ dr_id }_*.zip")))
+    if len(paths) == 0:
+        return None
+    return paths[-1]
+
+
+def resolve(snapshot_dir, name):
+    """ turn a --replay argument (a path, a file name in snapshot_dir, or a content hash) into a path """
+
+    if os.path.exists(name):
+        return name
+
+    path = os.path.join(snapshot_dir, name)
+    if os.path.exists(path):
+        return path
+
+    matches = sorted(glob.glob(os.path.join(snapshot_dir, f"*_{ name }*.zip")))
+    if len(matches) == 1:
+        return matches[0]
+    if len(matches) > 1:
+        raise Exception(f"snapshot '{ name }' is ambiguous: { [ os.path.basename(m) for m in matches ] }")
+
+    raise Exception(f"could not find snapshot '{ name }' in { snapshot_dir }")
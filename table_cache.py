@@ -0,0 +1,60 @@
+
+# on-disk cache of parsed spreadsheet tables (the avis report and the staff rosters).
+#
+# Parsing the xlsx/xls attachments is the most expensive part of a run, but the attachments only
+# change a few times a day.  The parsed rows are pickled, keyed by a hash of the attachment
+# contents and the id of the parser that produced them, so the next run with the same attachment
+# just unpickles them.
+#
+# Files in the cache directory:
+#   <kind>-<hash of parser id + contents hash>.pickle
+
+import os
+import os.path
+import pickle
+import hashlib
+import logging
+
+import file_store
+
+log = logging.getLogger(__name__)
+
+# entries not used in this many days are deleted
+MAX_AGE_DAYS = 14
+
+
+def _entry_path(cache_dir, kind, parser_id, digest):
+    key = hashlib.sha256(f"{ parser_id }\0{ digest }".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{ kind }-{ key }.pickle")
+
+
+def load(cache_dir, kind, parser_id, contents, parse, digest=None):
+    """ return parse(contents), using the cached result if these contents were parsed before.
+
+        parser_id names the parser (and its version): change it when parse's output changes.
+        digest is the sha256 hex digest of contents, if the caller already has it.
+    """
+
+    if digest is None:
+        digest = hashlib.sha256(contents).hexdigest()
+
+    path = _entry_path(cache_dir, kind, parser_id, digest)
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        os.utime(path)
+        log.debug(f"{ kind }: using cached parse { os.path.basename(path) }")
+        return data
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+        log.info(f"{ kind }: ignoring unreadable cache entry { path }: { e }")
+
+    data = parse(contents)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_store.atomic_open(path) as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    file_store.prune(cache_dir, MAX_AGE_DAYS)
+    return data
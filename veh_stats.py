@@ -4,16 +4,14 @@
 import logging
 import re
 
-import openpyxl.utils
-import openpyxl.styles
-
-import main
-
 log = logging.getLogger(__name__)
 
 
-def compute_stats(vehicles, roster, gap_prefix):
-    """ compute vehicle statistics by group """
+def compute_stats(vehicles, roster, gap_prefix, vehicle_to_gap):
+    """ compute vehicle statistics by group
+
+        vehicle_to_gap maps a vehicle to its GAP (passed in so this module doesn't import main)
+    """
 
     if gap_prefix != '' and gap_prefix != 'ALL':
         gap_regex = re.compile(f"^{ gap_prefix }/")
@@ -25,9 +23,9 @@ def compute_stats(vehicles, roster, gap_prefix):
     # compute total matching MDA people on the roster
     roster_count = 0
     for r in roster.values():
-        gap = r['GAP(s)']
-        tnm = r['T&M']
-        released = r['Released']
+        gap = r.gaps
+        tnm = r.tnm
+        released = r.released
 
         if tnm != "MDA":
             continue
@@ -38,17 +36,17 @@ def compute_stats(vehicles, roster, gap_prefix):
 
         if gap_regex.match(gap):
             roster_count += 1
-            #log.debug(f"roster: adding { r['Name'] } gap { gap } prefix '{ gap_prefix }' roster_count { roster_count }")
+            #log.debug(f"roster: adding { r.name } gap { gap } prefix '{ gap_prefix }' roster_count { roster_count }")
 
     vehicle_count = 0
     category_breakdown = {}
     for r in vehicles:
 
-        if r['Status'] != 'Active':
+        if r.Status != 'Active':
             continue
 
-        veh = r['Vehicle']
-        category = veh['VehicleCategoryCode']
+        veh = r.Vehicle
+        category = veh.VehicleCategoryCode
 
         if category not in category_breakdown:
             category_breakdown[category] = { 'category': category, 'count': 0 }
@@ -58,7 +56,7 @@ def compute_stats(vehicles, roster, gap_prefix):
         if category != 'R':
             continue
 
-        gap = main.vehicle_to_gap(r['Vehicle'])
+        gap = vehicle_to_gap(veh)
 
         if gap_regex.match(gap):
             vehicle_count += 1
@@ -15,13 +15,18 @@ import io
 import csv
 import sys
 import random
+import threading
 import urllib.parse
 
 import requests
+import requests.adapters
 import requests_html
+import urllib3.util.retry
 
 from http.cookiejar import LWPCookieJar, Cookie
 
+import file_store
+
 
 #from selenium import webdriver
 #from selenium.webdriver.common.keys import Keys
@@ -31,9 +36,116 @@ from http.cookiejar import LWPCookieJar, Cookie
 
 log = logging.getLogger(__name__)
 
+# status codes that are worth retrying; the DTT returns these when it is overloaded or restarting
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# the DR selector on the Vehicles page; only a logged in session gets it (see probe_login)
+LOGIN_MARKER = b'DisasterCodes'
+
+# one adapter (and hence one connection pool) is shared by every session in the run
+_adapter = None
+
+# logged in sessions, keyed by DTT user, so DRs that share an account log in once per run
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_timeout(config):
+    """ return the (connect, read) timeout tuple to use for DTT requests """
+    return (config.REQUESTS_CONNECT_TIMEOUT, config.REQUESTS_TIMEOUT)
+
+
+def get_adapter(config):
+    """ return the shared http adapter: pooled keep-alive connections plus retry with exponential backoff """
+    global _adapter
+
+    if _adapter is None:
+        retry = urllib3.util.retry.Retry(
+                total=config.REQUESTS_RETRIES,
+                backoff_factor=config.REQUESTS_BACKOFF_FACTOR,
+                status_forcelist=RETRY_STATUS_CODES,
+                allowed_methods=frozenset(['GET', 'HEAD']),     # never retry the login POSTs
+                respect_retry_after_header=True,
+                raise_on_status=False)
+
+        _adapter = requests.adapters.HTTPAdapter(
+                pool_connections=config.REQUESTS_POOL_CONNECTIONS,
+                pool_maxsize=config.REQUESTS_POOL_MAXSIZE,
+                max_retries=retry)
+
+    return _adapter
+
+
+def new_session(config):
+    """ make a new html session that uses the shared transport """
+
+    session = requests_html.HTMLSession()
+
+    adapter = get_adapter(config)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+
+def probe_login(config, session):
+    """ cheap check that the session is logged in.
+
+        A logged out session gets redirected to the SSO site, so the Vehicles page is fetched
+        without following redirects.  An error or interstitial page can also come back with a 200,
+        so the body is also checked for the DR selector (#DisasterCodes).  It is streamed, and
+        reading stops as soon as the selector shows up.
+    """
+
+    url = config.DTT_URL + "Vehicles"
+
+    r = session.get(url, timeout=get_timeout(config), allow_redirects=False, stream=True)
+    try:
+        if r.status_code != 200:
+            log.debug(f"login probe: status { r.status_code } location '{ r.headers.get('Location') }'")
+            return False
+
+        if not r.url.startswith(config.DTT_URL):
+            log.debug(f"login probe: ended up at '{ r.url }'")
+            return False
+
+        # keep the end of the previous chunk, in case the marker is split across two chunks
+        tail = b''
+        for chunk in r.iter_content(chunk_size=16384):
+            data = tail + chunk
+            if LOGIN_MARKER in data:
+                return True
+            tail = data[-len(LOGIN_MARKER):]
+
+        log.debug("login probe: the Vehicles page has no DR selector")
+        return False
+    finally:
+        r.close()
 
 
 def get_session(config, dr_config, session=None, force_new_session=False):
+    """ return a logged in session for the DR's DTT user.
+
+        Sessions are shared between DRs that use the same DTT user.  force_new_session throws
+        away the shared session (and its saved cookies) and logs in again; use it only after a
+        real authentication failure.
+    """
+
+    user_key = dr_config.dtt_user.lower()
+
+    with _sessions_lock:
+        if session == None and not force_new_session and user_key in _sessions:
+            log.debug(f"reusing session for { dr_config.dtt_user }")
+            return _sessions[user_key]
+
+        session = _new_login_session(config, dr_config, session, force_new_session)
+        _sessions[user_key] = session
+
+    return session
+
+
+def _new_login_session(config, dr_config, session, force_new_session):
 
     cookies = None
 
@@ -49,7 +161,7 @@ def get_session(config, dr_config, session=None, force_new_session=False):
             cookies = None
 
     if session == None:
-        session = requests_html.HTMLSession()
+        session = new_session(config)
 
     if cookies == None:
         cookies = _refresh_cookies_using_web(config, dr_config, session)
@@ -65,6 +177,17 @@ def get_session(config, dr_config, session=None, force_new_session=False):
     return session
 
 
+def save_cookies(cookies):
+    """ save a cookie jar to its file.
+
+        The file is shared by every DR (and --jobs worker) that logs in as the same user, so it
+        is replaced in one step rather than rewritten in place: a reader never loads a partial jar.
+    """
+
+    file_store.write_atomic(cookies.filename,
+            "#LWP-Cookies-2.0\n" + cookies.as_lwp_str(ignore_discard=True, ignore_expires=True), private=True)
+
+
 def _refresh_cookies_using_web(config, dr_config, session):
 
     cookies = None
@@ -73,7 +196,7 @@ def _refresh_cookies_using_web(config, dr_config, session):
         user = dr_config.dtt_user
         password = config['DTT_PASS']
         url = config['DTT_URL']
-        timeout = config['REQUESTS_TIMEOUT']
+        timeout = get_timeout(config)
 
         if user.lower().endswith(config['DTT_USER1_SUFFIX']):
             password = config.DTT_PASS1
@@ -89,7 +212,7 @@ def _refresh_cookies_using_web(config, dr_config, session):
                 c.expires = None
 
         # ZZZ: remove expiration date from cookies here...
-        cookies.save(ignore_discard=True, ignore_expires=True)
+        save_cookies(cookies)
 
     except:
         # something went wrong; don't return the cookies
@@ -131,7 +254,7 @@ def _get_login_web(session, user, password, url, timeout):
             'pf.adapterId': 'htmlFromARC',
             }
 
-    r = session.post(post_url, data=payload)
+    r = session.post(post_url, data=payload, timeout=timeout)
     r.raise_for_status()
 
 
@@ -157,7 +280,7 @@ def _get_login_web(session, user, password, url, timeout):
                     params[attrs['name']] = attrs['value']
         post_url = form.attrs['action']
 
-        r = session.post(post_url, data=params)
+        r = session.post(post_url, data=params, timeout=timeout)
         r.raise_for_status()
 
         log.info(f"got url { post_url } status_code { r.status_code } r.url { r.url } history { r.history }")
@@ -304,6 +427,6 @@ def requests_session_with_selenium_cookies(driver, dr_config, config):
 
         cookies.set_cookie(cookie)
 
-    cookies.save(ignore_discard=True, ignore_expires=True)
+    save_cookies(cookies)
     return cookies
 
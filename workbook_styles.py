@@ -0,0 +1,16 @@
+
+# cell styles for the generated workbooks.
+#
+# Importing this module imports openpyxl, so main.py only imports it from the functions that
+# render a workbook: modes that never build a spreadsheet don't pay for openpyxl.
+
+import openpyxl.styles
+
+
+FILL_RED = openpyxl.styles.PatternFill(fgColor="FFC0C0", fill_type = "solid")
+FILL_GREEN = openpyxl.styles.PatternFill(fgColor="C0FFC0", fill_type = "solid")
+FILL_YELLOW = openpyxl.styles.PatternFill(fgColor="FFFFC0", fill_type = "solid")
+FILL_BLUE = openpyxl.styles.PatternFill(fgColor="5BB1CD", fill_type = "solid")
+FILL_CYAN = openpyxl.styles.PatternFill(fgColor="A0FFFF", fill_type = "solid")
+FILL_GRAY = openpyxl.styles.PatternFill(fgColor="D0D0D0", fill_type = "solid")
+STRIKE_FONT = openpyxl.styles.Font(strike=True)